@@ -0,0 +1,221 @@
+# 离线压测：用本地替身代替所有上游，模拟多个用户的中文对话，经由真实的处理器（main.chat）回放，
+# 输出吞吐量和各阶段的 p50/p95/p99 延迟。数据库和各类缓存写在临时目录里，不影响正式数据
+#
+#   python benchmark.py --users 50 --messages 20
+#   python benchmark.py --json baseline.json                        # 保存结果
+#   python benchmark.py --baseline baseline.json --tolerance 0.2    # p95 变慢超过 20% 时返回非零
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import config
+
+USER_LINES = [
+    "今天上班好累啊", "晚上想吃火锅", "我家的猫又把杯子打翻了", "周末要不要一起去爬山",
+    "最近在学做蛋糕", "考试没考好，好难过", "你今天过得怎么样", "刚看完一部很好看的电影",
+    "明天要早起开会", "下雨了，不想出门", "我好想你呀", "推荐一首好听的歌吧",
+    "老板又让我加班", "今天跑了五公里", "感觉有点焦虑", "晚安，明天见"
+]
+
+
+class StageRecorder:
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, stage, seconds, ok=True):
+        self.durations[stage].append(seconds)
+        if not ok:
+            self.errors[stage] += 1
+
+    def timed(self, obj, attr, stage):
+        """把 obj.attr（同步或异步函数）换成记录耗时的版本"""
+        func = getattr(obj, attr)
+        recorder = self
+
+        if asyncio.iscoroutinefunction(func):
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                ok = False
+                try:
+                    result = await func(*args, **kwargs)
+                    ok = True
+                    return result
+                finally:
+                    recorder.record(stage, time.perf_counter() - start, ok)
+        else:
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                ok = False
+                try:
+                    result = func(*args, **kwargs)
+                    ok = True
+                    return result
+                finally:
+                    recorder.record(stage, time.perf_counter() - start, ok)
+        setattr(obj, attr, wrapper)
+
+    def summary(self):
+        import numpy as np
+        stages = {}
+        for stage, values in sorted(self.durations.items()):
+            p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+            stages[stage] = {
+                "count": len(values),
+                "errors": self.errors[stage],
+                "p50_ms": round(float(p50), 2),
+                "p95_ms": round(float(p95), 2),
+                "p99_ms": round(float(p99), 2)
+            }
+        return stages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="离线压测聊天处理流程")
+    parser.add_argument("--users", type=int, default=20, help="模拟的用户数")
+    parser.add_argument("--messages", type=int, default=10, help="每个用户发送的消息数")
+    parser.add_argument("--think-ms", type=float, default=200, help="用户两条消息之间的平均间隔（指数分布）")
+    parser.add_argument("--voice-ratio", type=float, default=0.3, help="开启语音的用户比例")
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="开启图片的用户比例")
+    parser.add_argument("--seed", type=int, default=42)
+    for name, median, p99 in (("openai", 400, 1500), ("elevenlabs", 300, 1000), ("stability", 3000, 8000),
+                              ("telegram", 50, 200), ("sentiment", 15, 40)):
+        parser.add_argument(f"--{name}-ms", type=float, default=median, help=f"{name} 延迟中位数（毫秒）")
+        parser.add_argument(f"--{name}-p99-ms", type=float, default=p99, help=f"{name} 延迟 p99（毫秒）")
+        parser.add_argument(f"--{name}-fail", type=float, default=0.0, help=f"{name} 失败比例")
+    parser.add_argument("--token-ms", type=float, default=20, help="OpenAI 每个 token 的生成时间（毫秒）")
+    parser.add_argument("--json", help="把结果写入此文件")
+    parser.add_argument("--baseline", help="与之前保存的结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95 允许变慢的比例")
+    return parser.parse_args(argv)
+
+
+def isolate_state(directory):
+    """数据库、缓存和索引都写到临时目录（必须在导入业务模块之前调用）"""
+    config.DATABASE_FILE = os.path.join(directory, "user_data.db")
+    config.EMOTION_CACHE_DB = os.path.join(directory, "emotion_cache.db")
+    config.MEMORY_DIR = os.path.join(directory, "memory_index")
+    config.AUDIO_CACHE_DIR = os.path.join(directory, "audio_cache")
+    config.IMAGE_CACHE_DIR = os.path.join(directory, "image_cache")
+
+
+async def run(args, recorder):
+    import fake_upstreams
+    rng = random.Random(args.seed)
+
+    def latency(name):
+        return fake_upstreams.LatencyModel(
+            getattr(args, f"{name}_ms"), getattr(args, f"{name}_p99_ms"), getattr(args, f"{name}_fail"),
+            random.Random(rng.random())
+        )
+
+    openai = fake_upstreams.FakeOpenAI(latency("openai"), recorder, token_ms=args.token_ms)
+    elevenlabs = fake_upstreams.FakeElevenLabs(latency("elevenlabs"), recorder)
+    stability = fake_upstreams.FakeStability(latency("stability"), recorder)
+    telegram = fake_upstreams.FakeTelegram(latency("telegram"), recorder)
+    fake_upstreams.install(openai, elevenlabs, stability)
+
+    import main
+    from update_processor import PerChatUpdateProcessor
+    main.emotion_analyzer.sentiment_service = fake_upstreams.FakeSentiment(latency("sentiment"), recorder)
+    main.image_jobs.start()
+    main.db.memory.warm_up()
+
+    # 本地阶段
+    recorder.timed(main.db.memory, "recall", "local.memory_recall")
+    recorder.timed(main.context_builder, "build", "local.context_build")
+    recorder.timed(main.personality_learner, "update_interests", "local.update_interests")
+    recorder.timed(main.personality_learner, "get_personalized_prompt", "local.personalized_prompt")
+    recorder.timed(main.db, "get_user_preferences", "local.get_preferences")
+    recorder.timed(main.db, "add_message", "local.add_message")
+    recorder.timed(main.speech, "synthesize", "voice.synthesize")
+
+    for user_id in range(1, args.users + 1):
+        main.db.add_user(user_id, f"user{user_id}", f"用户{user_id}", None)
+        main.db.update_user_preferences(
+            user_id,
+            voice_enabled=rng.random() < args.voice_ratio,
+            image_enabled=rng.random() < args.image_ratio
+        )
+
+    processor = PerChatUpdateProcessor()
+
+    async def user_session(user_id):
+        user_rng = random.Random(rng.random())
+        for _ in range(args.messages):
+            await asyncio.sleep(user_rng.expovariate(1000 / args.think_ms) if args.think_ms else 0)
+            text = user_rng.choice(USER_LINES)
+            update = telegram.update(user_id, text)
+            start = time.perf_counter()
+            await processor.process_update(update, main.chat(update, None))
+            recorder.record("chat.total", time.perf_counter() - start)
+            if update.message.first_reply_at is not None:
+                recorder.record("chat.first_text", update.message.first_reply_at - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user_session(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - start
+
+    # 等后台生图任务做完，再统计
+    await main.image_jobs.join()
+    await main.shutdown_clients(None)
+    return elapsed
+
+
+def report(result):
+    print(f"\n处理 {result['messages']} 条消息，用时 {result['elapsed_s']:.2f} 秒，"
+          f"吞吐量 {result['throughput_per_s']:.1f} 条/秒\n")
+    print(f"{'阶段':<28}{'次数':>8}{'失败':>6}{'p50(ms)':>11}{'p95(ms)':>11}{'p99(ms)':>11}")
+    for stage, row in result["stages"].items():
+        print(f"{stage:<28}{row['count']:>8}{row['errors']:>6}{row['p50_ms']:>11}{row['p95_ms']:>11}{row['p99_ms']:>11}")
+
+
+def compare(result, baseline, tolerance):
+    """返回 p95 变慢超过 tolerance 的阶段"""
+    regressions = []
+    for stage, row in result["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before and before["p95_ms"] > 0 and row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append((stage, before["p95_ms"], row["p95_ms"]))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    recorder = StageRecorder()
+    with tempfile.TemporaryDirectory(prefix="bench-") as directory:
+        isolate_state(directory)
+        elapsed = asyncio.run(run(args, recorder))
+
+    messages = args.users * args.messages
+    result = {
+        "args": vars(args),
+        "messages": messages,
+        "elapsed_s": elapsed,
+        "throughput_per_s": messages / elapsed,
+        "stages": recorder.summary()
+    }
+    report(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for stage, before, after in regressions:
+            print(f"⚠️ {stage} 的 p95 从 {before}ms 变为 {after}ms")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,16 +9,157 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')  # For voice synthesis
+ELEVENLABS_VOICE_ID = os.getenv('ELEVENLABS_VOICE_ID')  # 默认声音，没有单独配置 voice_id 的角色都用它
 STABILITY_API_KEY = os.getenv('STABILITY_API_KEY')    # For image generation
 
 # File paths
-CHARACTER_FILE = "character.json"
+CHARACTER_FILE = "characters.json"
+ROLE_PROMPTS_DIR = "role_prompts"
 DATABASE_FILE = "user_data.db"
+MODEL_CACHE_DIR = "model_cache"
+KEYWORD_DICT_FILE = "dicts/keyword_dict.txt"
+STOPWORDS_FILE = "dicts/stopwords.txt"
+MEMORY_DIR = "memory_index"
+AUDIO_CACHE_DIR = "audio_cache"
+IMAGE_CACHE_DIR = "image_cache"
 
 # Model settings
 GPT_MODEL = "gpt-3.5-turbo"
 VOICE_MODEL = "eleven_multilingual_v2"
 IMAGE_MODEL = "stable-diffusion-xl-1024-v1-0"
+SENTIMENT_MODEL = "uer/roberta-base-finetuned-dianping-chinese"
+
+# Sentiment inference settings
+SENTIMENT_BATCH_SIZE = int(os.getenv('SENTIMENT_BATCH_SIZE', '16'))       # 每批最多文本数
+SENTIMENT_MAX_WAIT_MS = float(os.getenv('SENTIMENT_MAX_WAIT_MS', '5'))    # 攒批最多等待毫秒数
+SENTIMENT_WORKER = os.getenv('SENTIMENT_WORKER', 'thread')                # thread: 本进程线程池；process: 独立推理进程
+SENTIMENT_QUANTIZE = os.getenv('SENTIMENT_QUANTIZE', 'none')              # none: fp32；int8: 动态量化（CPU 推理更快、内存更省）
+SENTIMENT_MIN_AGREEMENT = float(os.getenv('SENTIMENT_MIN_AGREEMENT', '0.95'))  # int8 与 fp32 标签一致率低于此值时退回 fp32
+
+# Emotion analysis cache settings
+EMOTION_CACHE_SIZE = int(os.getenv('EMOTION_CACHE_SIZE', '10000'))        # 内存和持久化文件中最多缓存的结果数
+EMOTION_CACHE_TTL = float(os.getenv('EMOTION_CACHE_TTL', '86400'))        # 缓存有效秒数
+EMOTION_CACHE_DB = os.getenv('EMOTION_CACHE_DB', 'emotion_cache.db')      # 持久化文件，留空则只缓存在内存
+
+# Lexical emotion pre-classifier settings（置信度阈值设为大于1即可关闭词典快速路径）
+EMOTION_LEXICON_FILE = "emotion_lexicon.json"
+EMOTION_LEXICON_MIN_HITS = int(os.getenv('EMOTION_LEXICON_MIN_HITS', '1'))                  # 至少命中的关键词数
+EMOTION_LEXICON_MIN_CONFIDENCE = float(os.getenv('EMOTION_LEXICON_MIN_CONFIDENCE', '0.75'))  # 主要情绪占命中词的最低比例
+
+# Emotion analysis mode
+# combined: 一次结构化补全同时返回回复和情绪；separate: 先单独调用GPT分析情绪再生成回复
+EMOTION_MODE = os.getenv('EMOTION_MODE', 'combined')
+
+# Reply delivery settings
+# stream: 边生成边发送，之后编辑同一条消息补全；full: 生成完整回复后再发送
+REPLY_MODE = os.getenv('REPLY_MODE', 'stream')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))   # 两次编辑消息的最短间隔（秒）
+STREAM_FIRST_CHARS = int(os.getenv('STREAM_FIRST_CHARS', '10'))          # 回复生成多少字后先发出第一段
+
+# Upstream connection settings
+ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1"
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '100'))    # 共享连接池上限
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv('UPSTREAM_MAX_KEEPALIVE', '20'))         # 保持的长连接数
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', '60'))  # 空闲长连接保留秒数
+BLOCKING_WORKERS = int(os.getenv('BLOCKING_WORKERS', '8'))                      # 无异步客户端的调用使用的线程数
+
+# Deadline and circuit breaker settings（单位：秒）
+CHAT_DEADLINE = float(os.getenv('CHAT_DEADLINE', '30'))              # 每条消息从收到到文字回复发出的时间上限
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '25'))            # 单次补全（含流式输出完）的超时
+EMOTION_TIMEOUT = float(os.getenv('EMOTION_TIMEOUT', '6'))           # 单独的情绪分析 GPT 调用超时，超时按中性情绪处理
+SENTIMENT_TIMEOUT = float(os.getenv('SENTIMENT_TIMEOUT', '2'))       # 情感模型推理超时，超时按中性处理
+ELEVENLABS_TIMEOUT = float(os.getenv('ELEVENLABS_TIMEOUT', '15'))    # 单句语音合成超时，超时跳过语音
+STABILITY_TIMEOUT = float(os.getenv('STABILITY_TIMEOUT', '60'))      # 单次生图超时，超时跳过图片
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))           # 连续失败多少次后熔断
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))  # 熔断多久后放行试探请求
+
+# Update processing settings
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))              # 同时处理的Telegram更新数（不同会话之间）
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '1000'))            # 等待处理的更新上限，超出时丢弃新更新
+UPDATE_CHAT_QUEUE_LIMIT = int(os.getenv('UPDATE_CHAT_QUEUE_LIMIT', '10'))    # 同一会话排队和处理中的更新上限
+
+# Bot serving mode
+# polling: 主动拉取更新；webhook: 由 Telegram 推送到本地 HTTP 服务（需要公网可访问的 WEBHOOK_URL）
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')                                  # 例如 https://example.com/telegram
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')                            # Telegram 推送时带上的校验令牌
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # Telegram 同时推送的连接数
+
+# Voice synthesis settings
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', '4'))                  # 同时合成的句子数
+TTS_PREWARM_CONCURRENCY = int(os.getenv('TTS_PREWARM_CONCURRENCY', '1'))  # 启动时预先合成固定回应用的并发数（单独计数，不占回复的名额）
+TTS_MIN_SENTENCE_CHARS = int(os.getenv('TTS_MIN_SENTENCE_CHARS', '6'))    # 短于此长度的句子并入下一句合成
+AUDIO_CACHE_MAX_CHARS = int(os.getenv('AUDIO_CACHE_MAX_CHARS', '30'))     # 不超过此长度的句子缓存合成结果（长句很少重复）
+
+# Image generation settings
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))          # 同时进行的生图任务数
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', '100'))  # 排队的生图任务上限，超出时丢弃新任务
+
+# Metrics settings
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))              # 本地 /metrics 端口（Prometheus 文本格式），0 表示不开启
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+TRACE_LOG = os.getenv('TRACE_LOG', '')                          # 每条消息各阶段耗时的 JSON 行日志文件，留空则不记录
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '0'))          # 只记录总耗时不低于此值的消息
+
+# Storage settings
+STORAGE_FLUSH_MS = float(os.getenv('STORAGE_FLUSH_MS', '5'))       # 写线程合并写入的时间窗口（毫秒）
+STORAGE_MAX_BATCH = int(os.getenv('STORAGE_MAX_BATCH', '500'))     # 单个事务最多合并的写操作数
+
+# Sharding settings
+# 按 user_id 一致性哈希分到 DATABASE_SHARDS 个数据库文件（0 号是 DATABASE_FILE，其余为 user_data.<n>.db）。
+# 修改分片数后需先停机运行 python sharding.py 迁移数据
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', '1'))
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '64'))                # 每个分片在哈希环上的虚拟节点数
+# 多个工作进程（仅 webhook 模式）：分片轮流分给各进程（分片号 % WORKER_COUNT），每个进程只处理自己分片里的用户，
+# 收到其他用户的更新时转发给对应进程；DATABASE_SHARDS 不能少于 WORKER_COUNT，最好是它的整数倍。WORKER_URLS 按序号列出各进程的 webhook 地址（逗号分隔）
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', '0'))
+WORKER_URLS = [url.strip() for url in os.getenv('WORKER_URLS', '').split(',') if url.strip()]
+
+# Chat history buffer settings
+HISTORY_BUFFER_SIZE = int(os.getenv('HISTORY_BUFFER_SIZE', '20'))        # 每个用户缓存的最近对话条数
+HISTORY_BUFFER_USERS = int(os.getenv('HISTORY_BUFFER_USERS', '10000'))   # 最多缓存多少个用户的对话
+
+# Chat history archive settings
+# 每个用户最近 ARCHIVE_HOT_TURNS 条和 ARCHIVE_HOT_DAYS 天内的对话留在 chat_history，
+# 更早的由后台任务压缩成按用户的归档段（chat_archive 表），需要时仍可读取
+ARCHIVE_HOT_TURNS = int(os.getenv('ARCHIVE_HOT_TURNS', '200'))            # 不小于滚动摘要回看的条数（HISTORY_BUFFER_SIZE * 10）
+ARCHIVE_HOT_DAYS = float(os.getenv('ARCHIVE_HOT_DAYS', '30'))
+ARCHIVE_SEGMENT_ROWS = int(os.getenv('ARCHIVE_SEGMENT_ROWS', '200'))      # 每个归档段最多的对话条数（也是单个写事务搬动的条数）
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '60'))             # 后台归档每隔多少秒跑一轮，0 表示不归档
+ARCHIVE_USERS_PER_STEP = int(os.getenv('ARCHIVE_USERS_PER_STEP', '50'))   # 每轮每个分片最多处理的用户数
+ARCHIVE_SCAN_ROWS = int(os.getenv('ARCHIVE_SCAN_ROWS', '20000'))          # 每轮每个分片按主键往后读多少行找可归档的用户
+ARCHIVE_VACUUM_PAGES = int(os.getenv('ARCHIVE_VACUUM_PAGES', '1000'))     # 每轮每个分片最多归还给文件系统的空闲页数
+
+# Context window settings
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))     # 每次补全的提示词 token 上限（含角色设定、摘要和历史）
+SUMMARY_EVERY_TURNS = int(os.getenv('SUMMARY_EVERY_TURNS', '10'))         # 有对话超出窗口时，每隔多少轮更新一次滚动摘要
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '300'))          # 摘要长度上限
+SUMMARY_INPUT_TOKENS = int(os.getenv('SUMMARY_INPUT_TOKENS', '3000'))     # 每次送去摘要的旧对话 token 上限
+
+# Long-term memory settings
+MEMORY_DIM = int(os.getenv('MEMORY_DIM', '64'))                   # 消息向量维数，搜索耗时与之成正比（改动后需运行 python memory_index.py 重建）
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', '3'))                # 每条消息召回的旧消息数
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', '0.35'))   # 召回的最低余弦相似度
+MEMORY_SKIP_RECENT = int(os.getenv('MEMORY_SKIP_RECENT', '10'))   # 最近几条消息已在上下文里，不参与召回
+MEMORY_OPEN_USERS = int(os.getenv('MEMORY_OPEN_USERS', '1000'))   # 最多同时保持内存映射的用户数
+MEMORY_RECALL_TIMEOUT = float(os.getenv('MEMORY_RECALL_TIMEOUT', '1'))  # 召回超时，超时不带长期记忆继续回复
+
+# User state cache settings
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '50000'))    # 最多缓存多少个用户的偏好和画像
+
+# Personality learner settings
+LEARNER_FLUSH_SECONDS = float(os.getenv('LEARNER_FLUSH_SECONDS', '2'))   # 内存中累加的兴趣计数多久写入一次
+PROFILE_TOP_KEYWORDS = int(os.getenv('PROFILE_TOP_KEYWORDS', '20'))      # 用户画像里保留的关键词数
+KEYWORD_SKETCH_CAPACITY = int(os.getenv('KEYWORD_SKETCH_CAPACITY', '64'))    # 每个用户最多跟踪的关键词数
+KEYWORD_HALF_LIFE_DAYS = float(os.getenv('KEYWORD_HALF_LIFE_DAYS', '30'))    # 兴趣计数衰减一半的天数，0 表示不衰减
+KEYWORD_SKETCH_USERS = int(os.getenv('KEYWORD_SKETCH_USERS', '50000'))       # 内存中最多保留多少个用户的关键词统计
+
+# Persona settings
+PERSONA_CHECK_SECONDS = float(os.getenv('PERSONA_CHECK_SECONDS', '5'))   # 多久检查一次角色文件是否有修改
 
 # Character settings
 DEFAULT_CHARACTER = {
@@ -26,5 +167,5 @@ DEFAULT_CHARACTER = {
     "personality": "温柔、略带占有欲的猫娘女友",
     "speaking_style": "喜欢用撒娇语气和主人聊天，说话结尾常带\"喵~\"",
     "background": "是一个可爱的AI猫娘，非常喜欢主人",
-    "voice_id": "voice_id_here"  # ElevenLabs voice ID
+    "voice_id": ELEVENLABS_VOICE_ID or "voice_id_here"  # ElevenLabs voice ID
 }
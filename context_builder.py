@@ -0,0 +1,190 @@
+# 按 token 预算组装对话上下文
+# 角色设定、个性化提示、滚动摘要、召回的长期记忆和本条消息先占预算，剩下的预算从新到旧填入最近的对话；
+# 放不下的旧对话由后台任务压缩进每个用户的滚动摘要（chat_summaries 表），摘要从不阻塞回复
+import asyncio
+from datetime import datetime
+from functools import lru_cache
+
+import upstream
+from config import (
+    CONTEXT_TOKEN_BUDGET, HISTORY_BUFFER_SIZE, SUMMARY_EVERY_TURNS,
+    SUMMARY_MAX_TOKENS, SUMMARY_INPUT_TOKENS
+)
+from deadlines import detached
+from storage import get_storage
+from token_counter import MESSAGE_OVERHEAD, REPLY_PRIMING, count_tokens
+from user_cache import get_user_cache
+
+SUMMARY_PROMPT = """下面是你（猫娘女友）和主人之前的聊天记录，以及更早聊天的摘要。
+请把它们合并成一段新的摘要，不超过{limit}字，用第三人称描述，
+保留主人的个人信息、喜好、经历的重要事情和还没聊完的话题，省略寒暄。只输出摘要。
+
+更早的摘要：{summary}
+
+聊天记录：
+{transcript}"""
+
+# 同一条消息的 token 数只算一次（历史消息每轮都会重新参与预算）
+_content_tokens = lru_cache(maxsize=HISTORY_BUFFER_SIZE * 1000)(count_tokens)
+
+
+def message_tokens(content):
+    return MESSAGE_OVERHEAD + _content_tokens(content)
+
+
+class ContextBuilder:
+    def __init__(self, db, storage=None, cache=None, budget=CONTEXT_TOKEN_BUDGET):
+        self.db = db
+        self.storage = storage or get_storage()
+        self.cache = cache or get_user_cache()
+        self.budget = budget
+        self.storage.ensure_schema(self.create_tables)
+        self._tasks = {}  # user_id -> 正在进行的摘要任务
+
+    def create_tables(self, conn):
+        # covered_until: 已并入摘要的最后一条 chat_history.id
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_until INTEGER NOT NULL,
+            updated_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+
+    def get_summary(self, user_id):
+        """(summary, covered_until)，还没有摘要时为 None"""
+        return self.cache.get(user_id, "summary", lambda: self.storage.for_user(user_id).query_one(
+            'SELECT summary, covered_until FROM chat_summaries WHERE user_id = ?', (user_id,)
+        ))
+
+    def build(self, user_id, persona, user_input, personalized_prompt=None, memories=(), reserve_tokens=0):
+        """组装发给模型的消息列表
+
+        memories 是长期记忆召回的旧消息，按相关度排序；
+        reserve_tokens 留给调用方之后追加的消息（如合并模式的输出格式要求）
+        """
+        user_message = {"role": "user", "content": user_input}
+        remaining = (self.budget - reserve_tokens - REPLY_PRIMING
+                     - persona["tokens"] - message_tokens(user_input))
+
+        head = [persona["system_message"]]
+        if personalized_prompt:
+            tokens = message_tokens(personalized_prompt)
+            if tokens <= remaining:
+                head.append({"role": "system", "content": personalized_prompt})
+                remaining -= tokens
+
+        summary = self.get_summary(user_id)
+        if summary:
+            content = f"之前聊天内容的摘要：{summary[0]}"
+            tokens = message_tokens(content)
+            if tokens <= remaining:
+                head.append({"role": "system", "content": content})
+                remaining -= tokens
+
+        # 相关的旧消息按相关度依次放入，放不下的丢弃
+        prefix = "主人以前说过的相关的话："
+        recalled = []
+        tokens = message_tokens(prefix)
+        for memory in memories:
+            line_tokens = _content_tokens(memory) + 2  # 换行和列表符号
+            if tokens + line_tokens > remaining:
+                break
+            recalled.append(f"- {memory}")
+            tokens += line_tokens
+        if recalled:
+            head.append({"role": "system", "content": "\n".join([prefix] + recalled)})
+            remaining -= tokens
+
+        # 从新到旧填入历史，直到预算用完
+        history = self.db.get_chat_history(user_id, HISTORY_BUFFER_SIZE)
+        window = []
+        for message, role in history:
+            tokens = message_tokens(message)
+            if tokens > remaining:
+                break
+            window.append({"role": role, "content": message})
+            remaining -= tokens
+        window.reverse()
+
+        # 有对话落在窗口之外（没放进预算，或缓冲已满说明更早还有记录）时，攒够轮数后在后台更新摘要
+        overflow = len(window) < len(history) or len(history) >= HISTORY_BUFFER_SIZE
+        self._maybe_summarize(user_id, len(window), overflow)
+
+        return head + window + [user_message]
+
+    def _maybe_summarize(self, user_id, kept, overflow):
+        # 距上次摘要的轮数和摘要一起存在按用户 LRU 的缓存里，不活跃的用户会被一并淘汰
+        turns = self.cache.peek(user_id, "summary_turns", 0) + 1
+        self.cache.set(user_id, "summary_turns", turns)
+        if not overflow or turns < SUMMARY_EVERY_TURNS or user_id in self._tasks:
+            return
+        self.cache.set(user_id, "summary_turns", 0)
+        task = asyncio.create_task(self._summarize(user_id, kept))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+
+    def _unsummarized_rows(self, user_id, covered_until, kept):
+        """窗口之外、还没并入摘要的对话，按时间从旧到新，最多 SUMMARY_INPUT_TOKENS"""
+        rows = self.storage.for_user(user_id).query('''
+        SELECT id, message, role FROM chat_history
+        WHERE user_id = ? AND id > ?
+        ORDER BY timestamp DESC
+        LIMIT ? OFFSET ?
+        ''', (user_id, covered_until, HISTORY_BUFFER_SIZE * 10, kept))
+        selected = []
+        total = 0
+        for row in rows:
+            total += message_tokens(row[1])
+            if total > SUMMARY_INPUT_TOKENS and selected:
+                break
+            selected.append(row)
+        selected.reverse()
+        return selected
+
+    async def _summarize(self, user_id, kept):
+        # 任务在处理消息时创建，会继承那条消息的截止时间；摘要不急，只受补全自身的超时限制
+        with detached():
+            await self._update_summary(user_id, kept)
+
+    async def _update_summary(self, user_id, kept):
+        try:
+            previous = self.get_summary(user_id)
+            summary, covered_until = previous or ("（无）", 0)
+            # 查询时本轮的两条消息可能还没提交，OFFSET 多跳过的部分留到下次摘要，不会遗漏
+            rows = await upstream.run_blocking(self._unsummarized_rows, user_id, covered_until, kept)
+            if not rows:
+                return
+            transcript = "\n".join(
+                f"{'主人' if role == 'user' else '我'}：{message}" for _, message, role in rows
+            )
+            new_summary = await upstream.chat_completion(
+                [{"role": "user", "content": SUMMARY_PROMPT.format(
+                    limit=SUMMARY_MAX_TOKENS, summary=summary, transcript=transcript
+                )}],
+                max_tokens=SUMMARY_MAX_TOKENS
+            )
+            if not new_summary:
+                return
+            new_summary = new_summary.strip()
+            covered_until = max(row[0] for row in rows)
+            self.storage.for_user(user_id).execute('''
+            INSERT INTO chat_summaries (user_id, summary, covered_until, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary,
+                covered_until = excluded.covered_until,
+                updated_at = excluded.updated_at
+            ''', (user_id, new_summary, covered_until, datetime.now()))
+            self.cache.set(user_id, "summary", (new_summary, covered_until))
+        except Exception as e:
+            print(f"更新聊天摘要出错：{e}")
+
+    async def close(self):
+        """取消还在进行的摘要任务"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
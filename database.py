@@ -1,15 +1,26 @@
-import sqlite3
 import json
+from collections import OrderedDict, deque
 from datetime import datetime
-from config import DATABASE_FILE
+from itertools import islice
+from config import HISTORY_BUFFER_SIZE, HISTORY_BUFFER_USERS
+from memory_index import get_memory_index
+from storage import get_storage
+from user_cache import get_user_cache
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_FILE)
-        self.create_tables()
+    def __init__(self, storage=None, cache=None, memory=None):
+        # 写入交给共享存储层排队组提交，读取不等待写入；按 user_id 路由到所在的分片
+        self.storage = storage or get_storage()
+        # 偏好设置按用户缓存，写入时同步更新缓存
+        self.cache = cache or get_user_cache()
+        # 主人的消息写入时同时追加到长期记忆索引
+        self.memory = memory or get_memory_index()
+        self.storage.ensure_schema(self.create_tables)
+        # 活跃用户最近 HISTORY_BUFFER_SIZE 条对话的环形缓冲（按用户 LRU 淘汰）
+        self._history = OrderedDict()
 
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    def create_tables(self, conn):
+        cursor = conn.cursor()
         
         # Create users table with indexes and constraints
         cursor.execute('''
@@ -35,6 +46,10 @@ class Database:
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
         ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user_time
+        ON chat_history (user_id, timestamp)
+        ''')
 
         # Create user_preferences table
         cursor.execute('''
@@ -47,64 +62,96 @@ class Database:
         )
         ''')
 
-        self.conn.commit()
-
     def add_user(self, user_id, username, first_name, last_name):
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        # 已经登记过的用户不再重复写入
+        if self.cache.peek(user_id, "registered"):
+            return
+        self.storage.for_user(user_id).execute('''
         INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, created_at, last_interaction)
         VALUES (?, ?, ?, ?, ?, ?)
         ''', (user_id, username, first_name, last_name, datetime.now(), datetime.now()))
-        self.conn.commit()
+        self.cache.set(user_id, "registered", True)
 
     def add_message(self, user_id, message, role):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO chat_history (user_id, message, role, timestamp)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, message, role, datetime.now()))
-        self.conn.commit()
+        # 先加载缓冲再排队写入，避免加载时读不到还没提交的这一条
+        self._history_buffer(user_id).append((message, role))
+        timestamp = datetime.now()
+
+        def insert(conn):
+            row_id = conn.execute('''
+            INSERT INTO chat_history (user_id, message, role, timestamp)
+            VALUES (?, ?, ?, ?)
+            ''', (user_id, message, role, timestamp)).lastrowid
+            # 向量在写线程里计算，不占用事件循环（召回时已算过的直接命中 embed 的缓存）
+            if role == "user":
+                self.memory.append(user_id, row_id, self.memory.embed(message))
+            return row_id
+
+        return self.storage.for_user(user_id).submit(insert)
 
     def get_chat_history(self, user_id, limit=10):
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        """最近 limit 条对话，新的在前"""
+        if limit <= HISTORY_BUFFER_SIZE:
+            buffer = self._history_buffer(user_id)
+            return list(islice(reversed(buffer), limit))
+        return self._query_history(user_id, limit)
+
+    def _query_history(self, user_id, limit):
+        return self.storage.for_user(user_id).query('''
         SELECT message, role FROM chat_history
         WHERE user_id = ?
         ORDER BY timestamp DESC
         LIMIT ?
         ''', (user_id, limit))
-        return cursor.fetchall()
+
+    def _history_buffer(self, user_id):
+        buffer = self._history.get(user_id)
+        if buffer is None:
+            rows = self._query_history(user_id, HISTORY_BUFFER_SIZE)
+            buffer = deque(reversed(rows), maxlen=HISTORY_BUFFER_SIZE)
+            self._history[user_id] = buffer
+            if len(self._history) > HISTORY_BUFFER_USERS:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(user_id)
+        return buffer
 
     def update_user_preferences(self, user_id, voice_enabled=None, image_enabled=None, personality=None):
-        cursor = self.conn.cursor()
-        updates = []
+        columns = []
         values = []
         
         if voice_enabled is not None:
-            updates.append("voice_enabled = ?")
+            columns.append("voice_enabled")
             values.append(voice_enabled)
         if image_enabled is not None:
-            updates.append("image_enabled = ?")
+            columns.append("image_enabled")
             values.append(image_enabled)
         if personality is not None:
-            updates.append("personality = ?")
+            columns.append("personality")
             values.append(personality)
             
-        if updates:
-            values.append(user_id)
+        if columns:
             query = f'''
-            INSERT INTO user_preferences (user_id, {", ".join(updates)})
-            VALUES (?, {", ".join(["?" for _ in updates])})
-            ON CONFLICT(user_id) DO UPDATE SET {", ".join(updates)}
+            INSERT INTO user_preferences (user_id, {", ".join(columns)})
+            VALUES (?, {", ".join(["?" for _ in columns])})
+            ON CONFLICT(user_id) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns)}
             '''
-            cursor.execute(query, values)
-            self.conn.commit()
+            self.storage.for_user(user_id).execute(query, [user_id] + values)
+
+            # 写穿缓存：按表的默认值补齐未设置的列，不必等写入提交
+            current = self.get_user_preferences(user_id) or (user_id, 1, 1, None)
+            self.cache.set(user_id, "preferences", (
+                user_id,
+                int(voice_enabled) if voice_enabled is not None else current[1],
+                int(image_enabled) if image_enabled is not None else current[2],
+                personality if personality is not None else current[3]
+            ))
 
     def get_user_preferences(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM user_preferences WHERE user_id = ?', (user_id,))
-        return cursor.fetchone()
+        return self.cache.get(user_id, "preferences", lambda: self.storage.for_user(user_id).query_one(
+            'SELECT * FROM user_preferences WHERE user_id = ?', (user_id,)
+        ))
 
     def close(self):
-        self.conn.close()       
+        self.storage.close()
     
\ No newline at end of file
@@ -0,0 +1,148 @@
+# 截止时间和熔断
+# 每条消息进来时设定截止时间（contextvar，随协程和它创建的任务向下传递），每次上游调用的超时取
+# 该服务自己的超时和剩余时间中较小的一个；截止时间已过时不再发出请求。
+# 每个上游服务一个熔断器：连续失败 BREAKER_FAILURES 次后断开，BREAKER_RESET_SECONDS 秒内的调用直接失败，
+# 之后放行一个试探请求，成功则恢复
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+from config import BREAKER_FAILURES, BREAKER_RESET_SECONDS
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class UpstreamUnavailable(Exception):
+    """上游暂时不可用（超时、熔断或截止时间已过），调用方应走降级路径"""
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+    pass
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    """在 seconds 秒后截止；已有更早的截止时间时保留更早的"""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def detached():
+    """不受外层截止时间限制（消息处理中启动的后台任务使用）"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """距截止时间的秒数，没有截止时间时为 None"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def timeout_for(limit):
+    """服务自己的超时与剩余时间中较小的一个（秒）"""
+    left = remaining()
+    if left is None:
+        return limit
+    return min(limit, left) if limit else left
+
+
+def _is_failure(error):
+    """客户端错误（4xx，限流除外）说明请求本身有问题，服务是好的，不计入熔断"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0          # 连续失败次数
+        self.opened_at = None      # 断开的时刻，闭合时为 None
+        self.probing = False       # 断开后正在试探
+        self.rejected = 0
+        self.timeouts = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    @property
+    def available(self):
+        """现在发出请求会不会被直接拒绝（不占用试探名额）"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def _acquire(self):
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        raise CircuitOpen(f"{self.name} 暂时不可用（熔断中）")
+
+    def _record(self, ok):
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.max_failures:
+                if self.opened_at is None:
+                    print(f"⚠️ {self.name} 连续失败 {self.failures} 次，暂停调用 {self.reset_seconds:g} 秒")
+                self.opened_at = time.monotonic()
+
+    async def call(self, coro_fn, *args, timeout=None, **kwargs):
+        """在熔断器保护下执行 await coro_fn(...)，超时取 timeout 与剩余时间中较小的一个"""
+        limit = timeout_for(timeout)
+        if limit is not None and limit <= 0:
+            raise UpstreamTimeout(f"{self.name}：截止时间已过")
+        probe = self._acquire()
+        try:
+            result = await asyncio.wait_for(coro_fn(*args, **kwargs), limit)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._record(False)
+            raise UpstreamTimeout(f"{self.name} 在 {limit:.2f} 秒内没有响应") from None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(not _is_failure(e))
+            raise
+        else:
+            self._record(True)
+            return result
+        finally:
+            if probe:
+                self.probing = False
+
+    def stats(self):
+        return {
+            "open": int(self.state != "closed"),
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts
+        }
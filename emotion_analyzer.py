@@ -1,11 +1,192 @@
-from transformers import pipeline
-import numpy as np
-from config import GPT_MODEL
-import openai
+import asyncio
+import json
+import re
+import upstream
+from config import (
+    EMOTION_LEXICON_FILE, EMOTION_LEXICON_MIN_HITS, EMOTION_LEXICON_MIN_CONFIDENCE,
+    EMOTION_TIMEOUT, SENTIMENT_TIMEOUT
+)
+from deadlines import timeout_for
+from emotion_cache import EmotionCache
+from emotion_lexicon import EmotionLexicon
+from metrics import metrics
+from sentiment_service import SentimentService
+
+EMOTION_LABELS = ("positive", "negative", "neutral", "angry", "sad", "happy", "love", "anxiety")
+
+# 合并模式下追加给模型的输出格式要求
+# reply 放在最后：流式输出时情绪字段先到，回复一开始就能确定情绪回应
+STRUCTURED_REPLY_INSTRUCTION = f"""请只返回一个JSON对象，不要输出其他内容，按以下顺序给出字段：
+- dominant_emotion: 主人这条消息的主要情绪（从以下选项中选择：{", ".join(EMOTION_LABELS)}）
+- intensity: 情绪强度（1-5的整数）
+- secondary_emotions: 次要情绪列表（从上面的选项中选择，可以为空）
+- reply: 给主人的回复内容（字符串）"""
+
+# 按情绪和强度给出的固定回应，会加在每条回复前面
+RESPONSE_TEMPLATES = {
+    "positive": {
+        1: "主人看起来心情不错呢~",
+        2: "主人开心我也很开心喵~",
+        3: "主人心情很好呢，要一直保持下去哦~",
+        4: "看到主人这么开心，我也超级开心喵~",
+        5: "主人太开心了，我也要跟着开心喵~"
+    },
+    "negative": {
+        1: "主人看起来有点不开心呢，要抱抱吗？",
+        2: "主人别难过，我在这里陪着你喵~",
+        3: "主人心情不好吗？要不要跟我说说？",
+        4: "主人别伤心，我会一直陪在你身边的喵~",
+        5: "主人别难过，让我来安慰你喵~"
+    },
+    "angry": {
+        1: "主人别生气，深呼吸一下喵~",
+        2: "主人消消气，我在这里陪着你喵~",
+        3: "主人别着急，慢慢来喵~",
+        4: "主人冷静一下，我永远支持你喵~",
+        5: "主人别生气，让我来安慰你喵~"
+    },
+    "sad": {
+        1: "主人别难过，我在这里喵~",
+        2: "主人伤心的话，我会心疼的喵~",
+        3: "主人别哭，我会一直陪着你喵~",
+        4: "主人难过的话，让我来抱抱你喵~",
+        5: "主人别伤心，我会永远陪在你身边喵~"
+    },
+    "love": {
+        1: "主人我也爱你喵~",
+        2: "主人最好了，我也最喜欢主人喵~",
+        3: "主人好温柔，我也最爱主人喵~",
+        4: "主人最棒了，我也最爱主人喵~",
+        5: "主人最可爱了，我也最爱主人喵~"
+    },
+    "anxiety": {
+        1: "主人别担心，一切都会好起来的喵~",
+        2: "主人别紧张，我在这里陪着你喵~",
+        3: "主人别害怕，我会保护你的喵~",
+        4: "主人别焦虑，我们一起面对喵~",
+        5: "主人别担心，我会一直陪着你喵~"
+    }
+}
+DEFAULT_RESPONSE = "主人我在这里喵~"
+
+
+def template_lines():
+    """所有固定回应（用于预先合成语音）"""
+    return [DEFAULT_RESPONSE] + [line for levels in RESPONSE_TEMPLATES.values() for line in levels.values()]
+
+
+_reply_key = re.compile(r'"reply"\s*:\s*"')
+_partial_unicode_escape = re.compile(r'\\u[0-9a-fA-F]{0,3}$')
+
+
+def default_emotion_analysis():
+    return {
+        "dominant_emotion": "neutral",
+        "intensity": 3,
+        "secondary_emotions": [],
+        "suggested_response": "保持友好和关心"
+    }
+
+
+def parse_emotion_analysis(data):
+    """按固定结构校验情绪字段，不符合时抛出 ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("情绪分析结果不是JSON对象")
+
+    dominant = data.get("dominant_emotion")
+    if dominant not in EMOTION_LABELS:
+        raise ValueError(f"未知的主要情绪：{dominant!r}")
+
+    intensity = data.get("intensity")
+    if isinstance(intensity, bool) or not isinstance(intensity, int) or not 1 <= intensity <= 5:
+        raise ValueError(f"情绪强度不合法：{intensity!r}")
+
+    secondary = data.get("secondary_emotions", [])
+    if not isinstance(secondary, list) or not all(e in EMOTION_LABELS for e in secondary):
+        raise ValueError(f"次要情绪不合法：{secondary!r}")
+
+    suggested = data.get("suggested_response", "")
+    if not isinstance(suggested, str):
+        raise ValueError(f"建议回应不合法：{suggested!r}")
+
+    return {
+        "dominant_emotion": dominant,
+        "intensity": intensity,
+        "secondary_emotions": secondary,
+        "suggested_response": suggested
+    }
+
+
+def parse_structured_reply(content):
+    """解析合并模式的补全结果，返回 (reply, emotion_analysis)
+
+    回复字段缺失时把原文当作回复；情绪字段不合法时退回中性情绪
+    """
+    try:
+        data = json.loads(content)
+    except ValueError:
+        print("结构化回复不是合法JSON，按纯文本处理")
+        return content, default_emotion_analysis()
+
+    reply = data.get("reply") if isinstance(data, dict) else None
+    if not isinstance(reply, str) or not reply.strip():
+        print("结构化回复缺少reply字段，按纯文本处理")
+        return content, default_emotion_analysis()
+
+    try:
+        emotion_analysis = parse_emotion_analysis(data)
+    except ValueError as e:
+        print(f"情绪分析出错：{e}")
+        emotion_analysis = default_emotion_analysis()
+    return reply, emotion_analysis
+
+
+def _decode_partial_string(raw):
+    """解码还没接收完整的 JSON 字符串内容（不含开头的引号）"""
+    escaped = False
+    for end, char in enumerate(raw):
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            raw = raw[:end]
+            break
+    else:
+        # 去掉末尾不完整的转义序列
+        if escaped:
+            raw = raw[:-1]
+        raw = _partial_unicode_escape.sub("", raw)
+    try:
+        text = json.loads(f'"{raw}"', strict=False)
+    except ValueError:
+        return ""
+    # 代理对只收到前一半时先不显示
+    if text and "\ud800" <= text[-1] <= "\udbff":
+        text = text[:-1]
+    return text
+
+
+def parse_partial_structured_reply(content):
+    """从合并模式未完成的输出里取出 (已生成的回复, 情绪字段)
+
+    还没开始输出回复时回复为 None；情绪字段不完整或不合法时为 None
+    """
+    match = _reply_key.search(content)
+    if match is None:
+        return None, None
+    head = content[:match.start()].rstrip().rstrip(",") + "}"
+    try:
+        emotion_analysis = parse_emotion_analysis(json.loads(head))
+    except ValueError:
+        emotion_analysis = None
+    return _decode_partial_string(content[match.end():]), emotion_analysis
+
 
 class EmotionAnalyzer:
     def __init__(self):
-        self.sentiment_analyzer = pipeline("sentiment-analysis", model="uer/roberta-base-finetuned-dianping-chinese")
+        self.sentiment_service = SentimentService()
+        self.cache = EmotionCache()
         self.emotion_categories = {
             "positive": ["开心", "快乐", "喜欢", "爱", "好", "棒", "优秀", "完美"],
             "negative": ["难过", "伤心", "讨厌", "恨", "坏", "差", "糟糕", "失败"],
@@ -16,10 +197,43 @@ class EmotionAnalyzer:
             "love": ["爱", "喜欢", "爱慕", "心动", "甜蜜"],
             "anxiety": ["焦虑", "担心", "害怕", "紧张", "不安"]
         }
+        self.lexicon = EmotionLexicon(
+            self.emotion_categories,
+            lexicon_file=EMOTION_LEXICON_FILE,
+            min_hits=EMOTION_LEXICON_MIN_HITS,
+            min_confidence=EMOTION_LEXICON_MIN_CONFIDENCE
+        )
+
+    @property
+    def ready(self):
+        return self.sentiment_service.ready
 
-    def analyze_text(self, text):
-        # 使用RoBERTa进行情感分析
-        sentiment_result = self.sentiment_analyzer(text)[0]
+    async def warm_up(self):
+        """加载情感模型，返回耗时（秒）"""
+        return await self.sentiment_service.warm_up()
+
+    async def analyze_sentiment(self, text):
+        # 模型预热完成前走降级路径：不做RoBERTa分析，按中性处理
+        if not self.ready:
+            metrics.events.inc(event="sentiment_degraded")
+            return {"label": "neutral", "score": 0.0, "degraded": True}
+
+        cached = self.cache.get("sentiment", text)
+        if cached is not None:
+            return cached
+
+        # 使用RoBERTa进行情感分析（与其他会话的消息攒批推理）；超时或出错时同样按中性处理，不耽误回复
+        try:
+            with metrics.stage("sentiment"):
+                sentiment_result = dict(await asyncio.wait_for(
+                    self.sentiment_service.classify(text), timeout_for(SENTIMENT_TIMEOUT)
+                ))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"情感分析出错：{e!r}")
+            metrics.events.inc(event="sentiment_degraded")
+            return {"label": "neutral", "score": 0.0, "degraded": True}
 
         # ✅ 映射标签为语义结果
         label_map = {
@@ -27,11 +241,33 @@ class EmotionAnalyzer:
             "LABEL_1": "positive"
         }
         sentiment_result["label"] = label_map.get(sentiment_result["label"], "neutral")
+        self.cache.put("sentiment", text, sentiment_result)
+        return sentiment_result
+
+    async def analyze_text(self, text):
+        """单独调用GPT做情绪分析（两次调用模式）"""
+        cached = self.cache.get("analysis", text)
+        if cached is not None:
+            return cached
+
+        sentiment_result = await self.analyze_sentiment(text)
 
-        # 使用GPT进行更细致的情绪分析
+        # 词典预分类足够确定时直接采用，不再调用GPT
+        lexical = self.lexicon.classify(text)
+        if lexical is not None:
+            metrics.events.inc(event="emotion_lexicon_hit")
+            result = {
+                "sentiment": sentiment_result,
+                "emotion_analysis": lexical
+            }
+            if not sentiment_result.get("degraded"):
+                self.cache.put("analysis", text, result)
+            return result
+
+        # 使用GPT进行更细致的情绪分析（可选阶段：超时、熔断或出错时按中性情绪处理）
         prompt = f"""
-        分析以下文本中的情绪，返回一个JSON格式的结果，包含以下字段：
-        - dominant_emotion: 主要情绪（从以下选项中选择：positive, negative, neutral, angry, sad, happy, love, anxiety）
+        分析以下文本中的情绪，只返回一个JSON对象，包含以下字段：
+        - dominant_emotion: 主要情绪（从以下选项中选择：{", ".join(EMOTION_LABELS)}）
         - intensity: 情绪强度（1-5的整数）
         - secondary_emotions: 次要情绪列表
         - suggested_response: 建议的回应方式
@@ -40,75 +276,63 @@ class EmotionAnalyzer:
         """
 
         try:
-            response = openai.ChatCompletion.create(
-                model=GPT_MODEL,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            emotion_analysis = eval(response.choices[0].message.content)
-            return {
-                "sentiment": sentiment_result,
-                "emotion_analysis": emotion_analysis
-            }
+            with metrics.stage("emotion_gpt"):
+                content = await upstream.chat_completion(
+                    [{"role": "user", "content": prompt}],
+                    timeout=EMOTION_TIMEOUT,
+                    response_format={"type": "json_object"}
+                )
+            emotion_analysis = parse_emotion_analysis(json.loads(content))
         except Exception as e:
             print(f"情绪分析出错：{e}")
+            metrics.events.inc(event="emotion_gpt_skipped")
             return {
                 "sentiment": sentiment_result,
-                "emotion_analysis": {
-                    "dominant_emotion": "neutral",
-                    "intensity": 3,
-                    "secondary_emotions": [],
-                    "suggested_response": "保持友好和关心"
-                }
+                "emotion_analysis": default_emotion_analysis()
             }
 
+        result = {
+            "sentiment": sentiment_result,
+            "emotion_analysis": emotion_analysis
+        }
+        # 降级（模型未就绪）时的结果不缓存
+        if not sentiment_result.get("degraded"):
+            self.cache.put("analysis", text, result)
+        return result
+
+    async def reply_with_emotion(self, messages, text, on_partial=None):
+        """一次结构化补全同时得到回复和情绪（合并模式）
+
+        RoBERTa 情感分析与补全并发执行，返回 (reply, emotion_data)。
+        给出 on_partial 时流式补全，每收到新内容就以 (已生成的回复, 情绪字段或 None) 调用它
+        """
+        messages = messages + [{"role": "system", "content": STRUCTURED_REPLY_INSTRUCTION}]
+        if on_partial is None:
+            completion = upstream.chat_completion(
+                messages, stage="completion", response_format={"type": "json_object"}
+            )
+        else:
+            async def on_content(content):
+                reply, emotion_analysis = parse_partial_structured_reply(content)
+                if reply:
+                    await on_partial(reply, emotion_analysis)
+
+            completion = upstream.stream_chat_completion(
+                messages, on_content, stage="completion", response_format={"type": "json_object"}
+            )
+        sentiment_result, content = await asyncio.gather(self.analyze_sentiment(text), completion)
+        reply, emotion_analysis = parse_structured_reply(content)
+        return reply, {
+            "sentiment": sentiment_result,
+            "emotion_analysis": emotion_analysis
+        }
+
+    async def close(self):
+        await self.sentiment_service.close()
+        self.cache.close()
+
     def get_emotional_response(self, emotion_data):
         """根据情绪分析结果生成合适的回应"""
         dominant = emotion_data["emotion_analysis"]["dominant_emotion"]
         intensity = emotion_data["emotion_analysis"]["intensity"]
-
-        response_templates = {
-            "positive": {
-                1: "主人看起来心情不错呢~",
-                2: "主人开心我也很开心喵~",
-                3: "主人心情很好呢，要一直保持下去哦~",
-                4: "看到主人这么开心，我也超级开心喵~",
-                5: "主人太开心了，我也要跟着开心喵~"
-            },
-            "negative": {
-                1: "主人看起来有点不开心呢，要抱抱吗？",
-                2: "主人别难过，我在这里陪着你喵~",
-                3: "主人心情不好吗？要不要跟我说说？",
-                4: "主人别伤心，我会一直陪在你身边的喵~",
-                5: "主人别难过，让我来安慰你喵~"
-            },
-            "angry": {
-                1: "主人别生气，深呼吸一下喵~",
-                2: "主人消消气，我在这里陪着你喵~",
-                3: "主人别着急，慢慢来喵~",
-                4: "主人冷静一下，我永远支持你喵~",
-                5: "主人别生气，让我来安慰你喵~"
-            },
-            "sad": {
-                1: "主人别难过，我在这里喵~",
-                2: "主人伤心的话，我会心疼的喵~",
-                3: "主人别哭，我会一直陪着你喵~",
-                4: "主人难过的话，让我来抱抱你喵~",
-                5: "主人别伤心，我会永远陪在你身边喵~"
-            },
-            "love": {
-                1: "主人我也爱你喵~",
-                2: "主人最好了，我也最喜欢主人喵~",
-                3: "主人好温柔，我也最爱主人喵~",
-                4: "主人最棒了，我也最爱主人喵~",
-                5: "主人最可爱了，我也最爱主人喵~"
-            },
-            "anxiety": {
-                1: "主人别担心，一切都会好起来的喵~",
-                2: "主人别紧张，我在这里陪着你喵~",
-                3: "主人别害怕，我会保护你的喵~",
-                4: "主人别焦虑，我们一起面对喵~",
-                5: "主人别担心，我会一直陪着你喵~"
-            }
-        }
-
-        return response_templates.get(dominant, {}).get(intensity, "主人我在这里喵~")
+        return RESPONSE_TEMPLATES.get(dominant, {}).get(intensity, DEFAULT_RESPONSE)
@@ -0,0 +1,117 @@
+# 情绪分析结果缓存
+# 按规范化后的文本内容寻址，内存里是有上限的 LRU（带过期时间），可选用 SQLite 持久化以便重启后继续命中。
+# 持久化文件只在启动时读一次（装进内存），之后查询只看内存；写入交给存储层的写线程攒批提交，
+# 不在事件循环里读写数据库。文件里最多保留 max_entries 条，过期和超出的由 prune 定期清理
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+from config import EMOTION_CACHE_SIZE, EMOTION_CACHE_TTL, EMOTION_CACHE_DB
+from storage import Storage
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """全半角统一、忽略大小写、合并空白"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _whitespace.sub(" ", text).strip()
+
+
+def cache_key(kind, text):
+    return hashlib.sha256(f"{kind}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmotionCache:
+    def __init__(self, max_entries=EMOTION_CACHE_SIZE, ttl=EMOTION_CACHE_TTL, db_path=EMOTION_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, json)
+        self.hits = 0
+        self.misses = 0
+        self.storage = None
+        if db_path:
+            self.storage = Storage(db_path)
+            self.storage.run(self.create_tables)
+            self.prune().result()
+            self._load()
+
+    def create_tables(self, conn):
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS emotion_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_emotion_cache_expires ON emotion_cache(expires_at)')
+
+    def _load(self):
+        """把持久化的结果按过期时间从早到晚装进内存，最晚过期的排在 LRU 的最近端"""
+        rows = self.storage.query('''
+        SELECT key, value, expires_at FROM emotion_cache
+        WHERE expires_at > ?
+        ORDER BY expires_at
+        ''', (time.time(),))
+        for key, value, expires_at in rows[-self.max_entries:]:
+            self._remember(key, expires_at, value)
+
+    def prune(self):
+        """删掉过期的结果，只保留最晚过期的 max_entries 条（排进写队列，返回 Future）"""
+        if self.storage is None:
+            return None
+        return self.storage.execute('''
+        DELETE FROM emotion_cache
+        WHERE expires_at < ?
+        OR key NOT IN (SELECT key FROM emotion_cache ORDER BY expires_at DESC LIMIT ?)
+        ''', (time.time(), self.max_entries))
+
+    def get(self, kind, text):
+        """返回缓存的结果（新的副本），未命中返回 None"""
+        key = cache_key(kind, text)
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[1])
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, kind, text, value):
+        key = cache_key(kind, text)
+        expires_at = time.time() + self.ttl
+        data = json.dumps(value, ensure_ascii=False)
+        self._remember(key, expires_at, data)
+        if self.storage is not None:
+            self.storage.execute('''
+            INSERT OR REPLACE INTO emotion_cache (key, value, expires_at)
+            VALUES (?, ?, ?)
+            ''', (key, data, expires_at))
+
+    def _remember(self, key, expires_at, data):
+        self._entries[key] = (expires_at, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
@@ -0,0 +1,167 @@
+# 词典情绪预分类
+# 把各情绪的关键词编译成 Aho-Corasick 自动机，一次扫描文本即可给所有情绪类别打分。
+# 结果足够确定时，EmotionAnalyzer 可以跳过单独的 GPT 情绪分析调用
+import json
+import os
+from collections import deque
+
+# 细分情绪，和粗粒度的 positive/negative/neutral 同分时优先
+FINE_GRAINED = ("angry", "sad", "happy", "love", "anxiety")
+NEGATORS = ("不", "没", "别", "无", "未")
+INTENSIFIERS = ("非常", "特别", "超级", "超", "太", "真", "好", "很", "最")
+
+
+class AhoCorasick:
+    """多模式串匹配自动机"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern in patterns:
+            self._insert(pattern)
+        self._build()
+
+    def _insert(self, pattern):
+        node = 0
+        for char in pattern:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            node = nxt
+        self.output[node].append(pattern)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(char, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def iter_matches(self, text):
+        """依次产出 (起始位置, 命中的模式串)"""
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for pattern in self.output[node]:
+                yield i - len(pattern) + 1, pattern
+
+
+class EmotionLexicon:
+    def __init__(self, categories, lexicon_file=None, min_hits=1, min_confidence=0.75):
+        """categories: {情绪: [关键词, ...]}；lexicon_file 里的词会追加到已有的情绪类别
+
+        词典文件格式与 categories 相同，关键词也可以写成 {关键词: 权重}
+        """
+        self.min_hits = min_hits
+        self.min_confidence = min_confidence
+        self.weights = {}  # 关键词 -> {情绪: 权重}
+        self.categories = list(categories)
+        self.add_words(categories)
+        if lexicon_file and os.path.exists(lexicon_file):
+            with open(lexicon_file, "r", encoding="utf-8") as f:
+                self.add_words(json.load(f))
+        self.matcher = AhoCorasick(self.weights)
+        self.fast_path_hits = 0
+        self.fast_path_misses = 0
+
+    def add_words(self, categories):
+        for category, words in categories.items():
+            if category not in self.categories:
+                print(f"词典中的情绪类别 {category} 不存在，已忽略")
+                continue
+            if isinstance(words, dict):
+                items = words.items()
+            else:
+                items = ((word, 1.0) for word in words)
+            for word, weight in items:
+                self.weights.setdefault(word, {})[category] = float(weight)
+
+    def _matches(self, text):
+        """最长匹配：去掉被更长关键词覆盖的命中（“好累”里不再单独算“好”）"""
+        matches = sorted(
+            ((start, start + len(word), word) for start, word in self.matcher.iter_matches(text)),
+            key=lambda m: (m[0], -m[1])
+        )
+        kept = []
+        covered = 0
+        for start, end, word in matches:
+            if end > covered:
+                kept.append((start, end, word))
+                covered = end
+        return kept
+
+    def score(self, text):
+        """一次扫描给所有情绪类别打分
+
+        返回 (scores, hits, negated, intensified)：各类别得分、命中词数、是否有否定词、是否有程度副词
+        """
+        scores = dict.fromkeys(self.categories, 0.0)
+        hits = 0
+        negated = False
+        intensified = False
+        matches = self._matches(text)
+        for i, (start, end, word) in enumerate(matches):
+            # “好难过”里的“好”是程度副词，不算正面情绪
+            if word in INTENSIFIERS and i + 1 < len(matches) and matches[i + 1][0] == end:
+                continue
+            hits += 1
+            prefix = text[max(0, start - 2):start]
+            if any(prefix.endswith(n) for n in NEGATORS):
+                negated = True
+            if any(prefix.endswith(w) for w in INTENSIFIERS):
+                intensified = True
+            for category, weight in self.weights[word].items():
+                scores[category] += weight
+        return scores, hits, negated, intensified
+
+    def classify(self, text):
+        """结果足够确定时返回与 GPT 情绪分析相同结构的结果，否则返回 None"""
+        scores, hits, negated, intensified = self.score(text)
+        total = sum(scores.values())
+        # 有否定词（“不开心”）时词典结果不可靠，交给GPT
+        if hits < self.min_hits or negated or total <= 0:
+            self.fast_path_misses += 1
+            return None
+
+        ranked = sorted(
+            scores.items(),
+            key=lambda item: (item[1], item[0] in FINE_GRAINED),
+            reverse=True
+        )
+        dominant, top = ranked[0]
+        # 一个词可能同时属于粗细两类（如“开心”属于 positive 和 happy），置信度按命中词数算
+        confidence = min(1.0, top / hits)
+        if confidence < self.min_confidence:
+            self.fast_path_misses += 1
+            return None
+
+        intensity = 3 + intensified + ("!" in text or "！" in text)
+        self.fast_path_hits += 1
+        return {
+            "dominant_emotion": dominant,
+            "intensity": min(5, intensity),
+            "secondary_emotions": [c for c, s in ranked[1:] if s > 0],
+            "suggested_response": "",
+            "source": "lexicon",
+            "confidence": confidence
+        }
+
+    def stats(self):
+        total = self.fast_path_hits + self.fast_path_misses
+        return {
+            "fast_path_hits": self.fast_path_hits,
+            "fast_path_misses": self.fast_path_misses,
+            "fast_path_rate": self.fast_path_hits / total if total else 0.0
+        }
@@ -0,0 +1,198 @@
+# 压测用的本地上游替身：OpenAI、ElevenLabs、Stability、Telegram 和情感模型
+# 每个替身按可配置的延迟分布（对数正态，给定中位数和 p99）等待，并按比例随机失败，
+# 不发出任何网络请求。调用耗时记录到传入的 recorder（record(stage, seconds, ok)）
+import asyncio
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+
+import upstream
+from emotion_analyzer import EMOTION_LABELS, STRUCTURED_REPLY_INSTRUCTION
+
+REPLY_SENTENCES = [
+    "主人今天辛苦啦，要好好休息哦。",
+    "我一直在这里等主人回来喵~",
+    "听起来很有意思呢，再多跟我说一点吧！",
+    "主人要记得按时吃饭，不然我会担心的。",
+    "我们周末一起去看电影好不好？",
+    "不管发生什么，我都会站在主人这边的。",
+    "这个问题我也想了很久呢，主人觉得呢？",
+    "嘿嘿，被主人夸了好开心喵~"
+]
+
+
+class UpstreamFailure(Exception):
+    """替身模拟的上游错误"""
+
+
+class LatencyModel:
+    def __init__(self, median_ms, p99_ms=None, failure_rate=0.0, rng=None):
+        self.median = median_ms / 1000
+        # 对数正态分布：p99 = 中位数 * exp(2.326 * sigma)
+        self.sigma = math.log(p99_ms / median_ms) / 2.326 if p99_ms and median_ms and p99_ms > median_ms else 0.0
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+
+    def sample(self):
+        return self.median * math.exp(self.sigma * self.rng.gauss(0, 1))
+
+    def fails(self):
+        return self.rng.random() < self.failure_rate
+
+
+class FakeService:
+    def __init__(self, name, latency, recorder):
+        self.name = name
+        self.latency = latency
+        self.recorder = recorder
+
+    async def call(self, stage, delay=None):
+        """等待一次调用的延迟，按失败率抛出 UpstreamFailure"""
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency.sample() if delay is None else delay)
+        ok = not self.latency.fails()
+        self.recorder.record(stage, time.perf_counter() - start, ok)
+        if not ok:
+            raise UpstreamFailure(f"{stage} 模拟失败")
+
+
+class FakeOpenAI(FakeService):
+    """按请求内容返回结构化回复、情绪分析 JSON 或纯文本；流式时逐段输出"""
+
+    def __init__(self, latency, recorder, token_ms=20.0, chunk_chars=4):
+        super().__init__("openai", latency, recorder)
+        self.token_ms = token_ms
+        self.chunk_chars = chunk_chars
+        self.rng = latency.rng
+
+    def _content(self, messages, kwargs):
+        reply = "".join(self.rng.sample(REPLY_SENTENCES, 2))
+        emotion = {
+            "dominant_emotion": self.rng.choice(EMOTION_LABELS),
+            "intensity": self.rng.randint(1, 5),
+            "secondary_emotions": []
+        }
+        if any(m["content"] == STRUCTURED_REPLY_INSTRUCTION for m in messages):
+            return json.dumps({**emotion, "reply": reply}, ensure_ascii=False)
+        if kwargs.get("response_format"):
+            return json.dumps({**emotion, "suggested_response": "温柔地回应"}, ensure_ascii=False)
+        return reply
+
+    async def chat_completion(self, messages, model=None, **kwargs):
+        content = self._content(messages, kwargs)
+        # 首个 token 的等待加上逐 token 生成的时间
+        await self.call("openai.completion", self.latency.sample() + len(content) * self.token_ms / 1000)
+        return content
+
+    async def stream_chat_completion(self, messages, on_partial, model=None, **kwargs):
+        content = self._content(messages, kwargs)
+        start = time.perf_counter()
+        await self.call("openai.first_token")
+        for end in range(self.chunk_chars, len(content) + self.chunk_chars, self.chunk_chars):
+            await asyncio.sleep(self.chunk_chars * self.token_ms / 1000)
+            await on_partial(content[:end])
+        self.recorder.record("openai.stream", time.perf_counter() - start, True)
+        return content
+
+
+class FakeElevenLabs(FakeService):
+    def __init__(self, latency, recorder, char_ms=5.0):
+        super().__init__("elevenlabs", latency, recorder)
+        self.char_ms = char_ms
+
+    async def synthesize_speech(self, text, voice_id, model=None):
+        await self.call("elevenlabs.tts", self.latency.sample() + len(text) * self.char_ms / 1000)
+        return f"{voice_id}:{text}".encode("utf-8")
+
+
+class FakeStability(FakeService):
+    def __init__(self, latency, recorder):
+        super().__init__("stability", latency, recorder)
+
+    async def generate_image(self, prompt, **params):
+        await self.call("stability.image")
+        return [f"PNG:{prompt}".encode("utf-8")]
+
+
+class FakeSentiment(FakeService):
+    """代替 SentimentService，模型视为已就绪"""
+
+    def __init__(self, latency, recorder):
+        super().__init__("sentiment", latency, recorder)
+        self.state = "ready"
+
+    @property
+    def ready(self):
+        return True
+
+    async def warm_up(self):
+        return 0.0
+
+    async def classify(self, text):
+        await self.call("sentiment.classify")
+        return {"label": self.latency.rng.choice(("LABEL_0", "LABEL_1")), "score": 0.9}
+
+    async def close(self):
+        pass
+
+
+class FakeTelegram(FakeService):
+    """Telegram Bot API 的替身，生成处理器需要的 Update 和 Message 对象"""
+
+    def __init__(self, latency, recorder):
+        super().__init__("telegram", latency, recorder)
+        self._message_id = 0
+
+    def message(self, user_id, text=""):
+        self._message_id += 1
+        return FakeMessage(self, user_id, self._message_id, text)
+
+    def update(self, user_id, text):
+        user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"用户{user_id}", last_name=None)
+        message = self.message(user_id, text)
+        message.from_user = user
+        return SimpleNamespace(
+            message=message,
+            effective_chat=SimpleNamespace(id=user_id),
+            effective_user=user,
+            callback_query=None
+        )
+
+
+class FakeMessage:
+    def __init__(self, telegram, chat_id, message_id, text):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.from_user = None
+        self.first_reply_at = None  # 第一条回复发出的时间（perf_counter）
+
+    async def reply_text(self, text, **kwargs):
+        await self.telegram.call("telegram.send_message")
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        return self.telegram.message(self.chat_id, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.telegram.call("telegram.edit_message")
+        self.text = text
+        return self
+
+    async def reply_voice(self, voice, **kwargs):
+        await self.telegram.call("telegram.send_voice")
+        return self.telegram.message(self.chat_id)
+
+    async def reply_photo(self, photo, **kwargs):
+        await self.telegram.call("telegram.send_photo")
+        return self.telegram.message(self.chat_id)
+
+
+def install(openai, elevenlabs, stability):
+    """把 upstream 模块里实际发请求的函数换成替身（超时和熔断仍然生效）"""
+    upstream._chat_completion = openai.chat_completion
+    upstream._stream_chat_completion = openai.stream_chat_completion
+    upstream._synthesize_speech = elevenlabs.synthesize_speech
+    upstream._generate_image = stability.generate_image
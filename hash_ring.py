@@ -0,0 +1,28 @@
+# 一致性哈希环
+# 每个节点在环上放 vnodes 个虚拟点，键落到顺时针方向的第一个点所属的节点。
+# 增加节点时只有落到新节点的键会移动（约 1/N），其余键的归属不变，迁移量最小。
+# 使用 blake2b 而不是内置 hash()，不同进程、不同机器算出的归属一致
+import hashlib
+from bisect import bisect_right
+
+from config import SHARD_VNODES
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError("哈希环至少需要一个节点")
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        i = bisect_right(self._points, _hash(key))
+        return self._owners[i % len(self._owners)]
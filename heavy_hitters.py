@@ -0,0 +1,86 @@
+# 有上限的高频项统计（Space-Saving 算法）
+# 每个用户最多跟踪 capacity 个关键词，内存固定；计数可以按半衰期指数衰减，让过时的兴趣慢慢淡出。
+# 衰减采用“放大新增量”的方式实现：新计数乘以随时间增长的权重，读取时再统一折算，不需要逐项衰减
+import heapq
+import time
+
+
+class SpaceSaving:
+    def __init__(self, capacity, half_life=None, now=None):
+        """half_life: 计数衰减一半所需的秒数，None 或 0 表示不衰减"""
+        self.capacity = capacity
+        self.half_life = half_life or None
+        self.epoch = time.time() if now is None else now
+        self.counts = {}  # item -> [放大后的计数, 放大后的误差上界]
+        self.changed = set()
+        self.removed = set()
+
+    def _weight(self, now):
+        if self.half_life is None:
+            return 1.0
+        return 2.0 ** ((now - self.epoch) / self.half_life)
+
+    def _rescale(self, now):
+        """权重过大时把所有计数折算到当前时刻，重置起点"""
+        weight = self._weight(now)
+        for entry in self.counts.values():
+            entry[0] /= weight
+            entry[1] /= weight
+        self.epoch = now
+
+    def add(self, item, n=1, now=None):
+        now = time.time() if now is None else now
+        weight = self._weight(now)
+        if weight > 1e12:
+            self._rescale(now)
+            weight = 1.0
+
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += n * weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [n * weight, 0.0]
+        else:
+            # 替换计数最小的项，新项继承其计数作为误差上界
+            victim = min(self.counts, key=lambda k: self.counts[k][0])
+            floor = self.counts.pop(victim)[0]
+            self.counts[item] = [floor + n * weight, floor]
+            self.removed.add(victim)
+            self.changed.discard(victim)
+        self.removed.discard(item)
+        self.changed.add(item)
+
+    def load(self, item, count, error=0.0, age=0.0, now=None):
+        """载入持久化的计数（age 为距上次写入的秒数，会按半衰期折算）"""
+        now = time.time() if now is None else now
+        scale = self._weight(now)
+        if self.half_life is not None:
+            scale *= 2.0 ** (-age / self.half_life)
+        self.counts[item] = [count * scale, error * scale]
+
+    def count(self, item, now=None):
+        entry = self.counts.get(item)
+        if entry is None:
+            return 0.0
+        return entry[0] / self._weight(time.time() if now is None else now)
+
+    def top(self, k, now=None):
+        """计数最高的 k 项 [(item, count)]，只在固定容量内比较，耗时与历史长度无关"""
+        weight = self._weight(time.time() if now is None else now)
+        best = heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1][0])
+        return [(item, entry[0] / weight) for item, entry in best]
+
+    def drain_changes(self, now=None):
+        """取出自上次以来变化的项 [(item, count, error)] 和被挤出的项，用于增量持久化"""
+        weight = self._weight(time.time() if now is None else now)
+        changed = [
+            (item, self.counts[item][0] / weight, self.counts[item][1] / weight)
+            for item in self.changed
+        ]
+        removed = list(self.removed)
+        self.changed = set()
+        self.removed = set()
+        return changed, removed
+
+    def __len__(self):
+        return len(self.counts)
@@ -0,0 +1,295 @@
+# 聊天记录归档
+# chat_history 只保留每个用户最近的对话（ARCHIVE_HOT_TURNS 条以内或 ARCHIVE_HOT_DAYS 天以内），
+# 更早的对话由后台任务按用户压缩成归档段（zlib 压缩的 JSON，存在同一分片的 chat_archive 表里）。
+# 每次只搬一段（最多 ARCHIVE_SEGMENT_ROWS 条），写入归档段和删除原记录在同一个短事务里完成，
+# 之后用 incremental_vacuum 分批把空闲页还给文件系统，不会长时间锁库。
+# 每轮只从上次停下的地方按主键往后读一页（ARCHIVE_SCAN_ROWS 行）找有冷数据的用户，读到表尾后从头再来，
+# 不会每轮都扫全表（迁移分片后旧对话的 id 会排到新对话后面，所以不能读到热数据就停）。
+# 归档的对话仍可按需读取：长期记忆召回、画像和记忆索引重建都会读归档段。
+#
+#   python history_archive.py            # 立即把所有分片归档一遍
+#   python history_archive.py --vacuum   # 一次性把旧数据库转换为 incremental 自动清理（需停机，会锁库较久）
+import argparse
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from config import (
+    ARCHIVE_HOT_TURNS, ARCHIVE_HOT_DAYS, ARCHIVE_SEGMENT_ROWS, ARCHIVE_USERS_PER_STEP, ARCHIVE_SCAN_ROWS,
+    ARCHIVE_VACUUM_PAGES
+)
+from metrics import metrics
+from storage import get_storage
+
+# 一个用户可以归档的冷数据：早于截止时间，且不在最近 hot_turns 条之内（参数：user_id, 截止时间, user_id, hot_turns - 1）
+_COLD_ROWS = '''
+user_id = ? AND timestamp < ? AND id < (
+    SELECT id FROM chat_history WHERE user_id = ?
+    ORDER BY id DESC LIMIT 1 OFFSET ?
+)
+'''
+
+# 解压后的归档段缓存（(分片文件, 段 id) -> 行），召回时同一段常被反复读取
+DECODED_SEGMENTS = 64
+
+
+def encode_segment(rows):
+    """rows: [(id, message, role, timestamp)] -> 压缩后的字节"""
+    data = json.dumps([[row_id, message, role, str(timestamp)] for row_id, message, role, timestamp in rows],
+                      ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(data.encode("utf-8"), 6)
+
+
+def decode_segment(blob):
+    return [tuple(row) for row in json.loads(zlib.decompress(blob).decode("utf-8"))]
+
+
+class HistoryArchive:
+    def __init__(self, storage=None, hot_turns=ARCHIVE_HOT_TURNS, hot_days=ARCHIVE_HOT_DAYS,
+                 segment_rows=ARCHIVE_SEGMENT_ROWS):
+        self.storage = storage or get_storage()
+        self.hot_turns = max(1, hot_turns)
+        self.hot_days = hot_days
+        self.segment_rows = segment_rows
+        self.storage.ensure_schema(self.create_tables)
+        self._decoded = OrderedDict()
+        self._decoded_lock = threading.Lock()  # 召回（线程池）和归档任务都会读写解压缓存
+        self._cursors = {}  # 分片 -> 上一轮读到的 chat_history.id，0 表示从头开始
+        self._incremental = {}  # 分片 -> 是否为 incremental 自动清理
+        self.archived_rows = 0
+        self.archived_segments = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def create_tables(self, conn):
+        # first_id / last_id: 段内对话的 chat_history.id 范围
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            segment_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            first_time TIMESTAMP,
+            last_time TIMESTAMP,
+            row_count INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            created_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+        conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_archive_user
+        ON chat_archive (user_id, last_id)
+        ''')
+
+    # ---- 归档 ----
+
+    def _archive_segment(self, conn, user_id, cutoff):
+        """把一个用户最早的一段冷数据搬进归档段，返回搬动的条数（在写线程里执行）"""
+        rows = conn.execute(f'''
+        SELECT id, message, role, timestamp FROM chat_history
+        WHERE {_COLD_ROWS}
+        ORDER BY id
+        LIMIT ?
+        ''', (user_id, cutoff, user_id, self.hot_turns - 1, self.segment_rows)).fetchall()
+        if not rows:
+            return 0
+        blob = encode_segment(rows)
+        conn.execute('''
+        INSERT INTO chat_archive (user_id, first_id, last_id, first_time, last_time, row_count, data, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, rows[0][0], rows[-1][0], rows[0][3], rows[-1][3], len(rows), blob, datetime.now()))
+        conn.executemany('DELETE FROM chat_history WHERE id = ?', [(row[0],) for row in rows])
+        self.raw_bytes += sum(len((row[1] or "").encode("utf-8")) for row in rows)
+        self.compressed_bytes += len(blob)
+        return len(rows)
+
+    def compact_user(self, user_id):
+        """把一个用户的冷数据全部归档，返回归档的条数"""
+        storage = self.storage.for_user(user_id)
+        cutoff = datetime.now() - timedelta(days=self.hot_days)
+        total = 0
+        while True:
+            # 每段一个短事务，和正常写入一起排队组提交
+            moved = storage.run(lambda conn: self._archive_segment(conn, user_id, cutoff))
+            if not moved:
+                break
+            total += moved
+            self.archived_rows += moved
+            self.archived_segments += 1
+            if moved < self.segment_rows:
+                break
+        return total
+
+    def _candidates(self, storage, after_id, cutoff, scan_rows, max_users):
+        """从 after_id 往后按主键读一页，返回 (有冷数据可归档的用户, 下一轮的起点)；读到表尾时下一轮从头开始"""
+        rows = storage.query('''
+        SELECT id, user_id, timestamp < ? FROM chat_history
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+        ''', (cutoff, after_id, scan_rows))
+        seen = set()
+        users = []
+        for row_id, user_id, cold in rows:
+            if not cold or user_id in seen:
+                continue
+            if len(seen) >= max_users:
+                return users, row_id - 1
+            seen.add(user_id)
+            if storage.query_one(f'SELECT 1 FROM chat_history WHERE {_COLD_ROWS} LIMIT 1',
+                                 (user_id, cutoff, user_id, self.hot_turns - 1)):
+                users.append(user_id)
+        return users, rows[-1][0] if len(rows) == scan_rows else 0
+
+    def compact_step(self, shards=None, max_users=ARCHIVE_USERS_PER_STEP, vacuum_pages=ARCHIVE_VACUUM_PAGES,
+                     scan_rows=ARCHIVE_SCAN_ROWS):
+        """后台归档一轮：每个分片往后读 scan_rows 行、处理其中最多 max_users 个用户，再归还最多 vacuum_pages 个空闲页
+
+        shards 为 None 时处理全部分片；返回归档的条数
+        """
+        cutoff = datetime.now() - timedelta(days=self.hot_days)
+        total = 0
+        with metrics.stage("archive.compact"):
+            for index in (range(self.storage.count) if shards is None else shards):
+                storage = self.storage.shard(index)
+                users, self._cursors[index] = self._candidates(
+                    storage, self._cursors.get(index, 0), cutoff, scan_rows, max_users
+                )
+                for user_id in users:
+                    total += self.compact_user(user_id)
+                if vacuum_pages and self._incremental_vacuum(index, storage):
+                    storage.maintain(lambda conn: conn.executescript(
+                        f'PRAGMA incremental_vacuum({int(vacuum_pages)});'
+                    )).result()
+        if total:
+            metrics.events.inc(total, event="history_archived_rows")
+        return total
+
+    @property
+    def wrapped(self):
+        """所有分片都已读完一遍、下一轮从头开始"""
+        return not any(self._cursors.values())
+
+    def _incremental_vacuum(self, index, storage):
+        incremental = self._incremental.get(index)
+        if incremental is None:
+            incremental = self._incremental[index] = storage.query_one('PRAGMA auto_vacuum')[0] == 2
+            if not incremental:
+                print(f"⚠️ 分片 {index} 不是 incremental 自动清理，归档腾出的空间只能复用、不会归还；"
+                      f"可停机运行 python history_archive.py --vacuum 转换")
+        return incremental
+
+    # ---- 读取 ----
+
+    def _segment_rows(self, storage, segment_id, blob):
+        key = (storage.path, segment_id)
+        with self._decoded_lock:
+            rows = self._decoded.get(key)
+            if rows is not None:
+                self._decoded.move_to_end(key)
+                return rows
+        # 解压放在锁外，其他线程不用等
+        rows = decode_segment(blob)
+        with self._decoded_lock:
+            self._decoded[key] = rows
+            self._decoded.move_to_end(key)
+            if len(self._decoded) > DECODED_SEGMENTS:
+                self._decoded.popitem(last=False)
+        return rows
+
+    def read(self, user_id, role=None, storage=None):
+        """一个用户的全部归档对话 [(id, message, role, timestamp)]，按时间从旧到新"""
+        storage = storage or self.storage.for_user(user_id)
+        rows = []
+        for segment_id, blob in storage.query(
+            'SELECT segment_id, data FROM chat_archive WHERE user_id = ? ORDER BY first_id', (user_id,)
+        ):
+            rows.extend(r for r in self._segment_rows(storage, segment_id, blob) if role is None or r[2] == role)
+        return rows
+
+    def messages(self, user_id, ids):
+        """按 chat_history.id 取归档的消息原文 {id: message}（只解压包含这些 id 的段）"""
+        wanted = set(ids)
+        if not wanted:
+            return {}
+        found = {}
+        storage = self.storage.for_user(user_id)
+        for segment_id, blob in storage.query('''
+        SELECT segment_id, data FROM chat_archive
+        WHERE user_id = ? AND last_id >= ? AND first_id <= ?
+        ''', (user_id, min(wanted), max(wanted))):
+            for row_id, message, _, _ in self._segment_rows(storage, segment_id, blob):
+                if row_id in wanted:
+                    found[row_id] = message
+        return found
+
+    def scan(self, storage, role=None, batch_size=500):
+        """逐段读出一个分片里的全部归档对话 (id, user_id, message, timestamp)，同一用户按时间从旧到新"""
+        last_segment = 0
+        while True:
+            segments = storage.query('''
+            SELECT segment_id, user_id, data FROM chat_archive
+            WHERE segment_id > ?
+            ORDER BY segment_id
+            LIMIT ?
+            ''', (last_segment, batch_size))
+            if not segments:
+                return
+            for segment_id, user_id, blob in segments:
+                for row_id, message, row_role, timestamp in decode_segment(blob):
+                    if role is None or row_role == role:
+                        yield row_id, user_id, message, timestamp
+            last_segment = segments[-1][0]
+
+    def stats(self):
+        return {
+            "archived_rows": self.archived_rows,
+            "archived_segments": self.archived_segments,
+            "compression_ratio": self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+        }
+
+
+_archive = None
+
+
+def get_history_archive():
+    """进程内共享的聊天记录归档"""
+    global _archive
+    if _archive is None:
+        _archive = HistoryArchive()
+    return _archive
+
+
+def convert_auto_vacuum(archive):
+    """把旧数据库转换为 incremental 自动清理（VACUUM 会重写整个文件，需停机执行）"""
+    for index in range(archive.storage.count):
+        shard = archive.storage.shard(index)
+        mode = shard.query_one('PRAGMA auto_vacuum')[0]
+        if mode == 2:
+            continue
+        shard.maintain(lambda conn: conn.executescript('PRAGMA auto_vacuum=INCREMENTAL; VACUUM;')).result()
+        archive._incremental.pop(index, None)
+        print(f"分片 {index} 已转换为 incremental 自动清理")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="归档旧的聊天记录")
+    parser.add_argument("--vacuum", action="store_true", help="一次性转换旧数据库的自动清理模式（需停机）")
+    args = parser.parse_args()
+    from database import Database
+    db = Database()
+    archive = get_history_archive()
+    if args.vacuum:
+        convert_auto_vacuum(archive)
+    total = 0
+    while True:
+        archived = archive.compact_step(max_users=1000)
+        total += archived
+        # 完整读完一遍且没有可归档的数据为止
+        if not archived and archive.wrapped:
+            break
+    print(f"已归档 {total} 条对话，{archive.stats()}")
+    db.close()
@@ -0,0 +1,152 @@
+# 后台生图任务队列
+# 文字回复不等图片：生图请求放进有上限的队列，由固定数量的后台任务依次处理。
+# 同一用户还没开始的任务只保留最新的一个；队列满时直接丢弃新任务。
+# 生成结果按 提示词+参数 的哈希缓存在磁盘上（种子固定，相同参数的结果相同），图片字节直接从内存发送
+import asyncio
+import hashlib
+import json
+import os
+
+import upstream
+from config import IMAGE_CACHE_DIR, IMAGE_QUEUE_SIZE, IMAGE_WORKERS, IMAGE_MODEL
+from metrics import metrics
+
+IMAGE_PARAMS = {"seed": 42, "steps": 30, "cfg_scale": 7.0, "width": 512, "height": 512, "samples": 1}
+
+
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, prompt, params):
+        payload = json.dumps({"model": IMAGE_MODEL, "prompt": prompt, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _dir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """缓存的图片字节列表，没有时返回 None"""
+        directory = self._dir(key)
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return None
+        images = []
+        for name in names:
+            if name.endswith(".png"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    images.append(f.read())
+        return images or None
+
+    def put(self, key, images):
+        # 先写到临时目录再整体改名，读到的要么是完整结果要么没有
+        directory = self._dir(key)
+        tmp = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for i, binary in enumerate(images):
+            with open(os.path.join(tmp, f"{i}.png"), "wb") as f:
+                f.write(binary)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            # 其他进程已经写好了同样的结果
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+
+class ImageJobQueue:
+    def __init__(self, workers=IMAGE_WORKERS, max_queued=IMAGE_QUEUE_SIZE, cache=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.cache = cache or ImageCache()
+        self._queue = asyncio.Queue()   # 等待处理的 user_id
+        self._pending = {}              # user_id -> (prompt, send)，还没开始的任务
+        self._inflight = {}             # 缓存键 -> 正在生成的 Future，不同用户的相同请求只生成一次
+        self._tasks = []
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id, prompt, send):
+        """提交生图任务，生成后调用 await send(images)；队列已满被丢弃时返回 False"""
+        if user_id in self._pending:
+            # 同一用户还没开始的任务换成最新的请求
+            self._pending[user_id] = (prompt, send)
+            self.coalesced += 1
+            return True
+        if self._queue.qsize() >= self.max_queued:
+            self.dropped += 1
+            return False
+        self._pending[user_id] = (prompt, send)
+        self._queue.put_nowait(user_id)
+        return True
+
+    async def generate(self, prompt, params=IMAGE_PARAMS):
+        """生成图片（优先读缓存），返回图片字节列表"""
+        key = self.cache.key(prompt, params)
+        images = await upstream.run_blocking(self.cache.get, key)
+        if images is not None:
+            self.hits += 1
+            return images
+        self.misses += 1
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            with metrics.stage("image"):
+                images = await upstream.generate_image(prompt, **params)
+            if images:
+                await upstream.run_blocking(self.cache.put, key, images)
+            future.set_result(images)
+            return images
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            job = self._pending.pop(user_id, None)
+            try:
+                if job is not None:
+                    prompt, send = job
+                    await send(await self.generate(prompt))
+            except Exception as e:
+                print(f"生成图片出错：{e}")
+            finally:
+                self._queue.task_done()
+
+    async def join(self):
+        """等待已提交的任务全部完成"""
+        await self._queue.join()
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped
+        }
+
+    async def close(self):
+        """停止后台任务，未开始的任务直接丢弃"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
@@ -0,0 +1,132 @@
+# 中文关键词提取
+# 基于词典的最大概率分词：用前缀词典为句子建立有向无环图（DAG），动态规划找出词频概率最大的切分路径，
+# 词典里没有的词会被拆成单字，连续的几个生词单字合成一个候选词（“杯子”不在词典里时得到“杯子”而不是“杯”“子”），
+# 再去掉停用词、单字和纯数字。词典和停用词表都随仓库提供（dicts/），不依赖网络
+import math
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from config import KEYWORD_DICT_FILE, STOPWORDS_FILE
+
+_blocks = re.compile(r"([\u4e00-\u9fff]+|[A-Za-z][A-Za-z0-9+#._-]*|\d+)")
+_han = re.compile(r"[\u4e00-\u9fff]")
+
+
+def _read_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+class Segmenter:
+    def __init__(self, dict_file=KEYWORD_DICT_FILE):
+        self.freq = {}
+        self.total = 0
+        for line in _read_lines(dict_file):
+            parts = line.split()
+            self.add_word(parts[0], int(parts[1]) if len(parts) > 1 else 1)
+
+    def add_word(self, word, freq=1):
+        """加入新词；同时登记它的所有前缀（词频为 0），建 DAG 时据此提前结束扫描"""
+        self.total += freq - self.freq.get(word, 0)
+        self.freq[word] = freq
+        for i in range(1, len(word)):
+            self.freq.setdefault(word[:i], 0)
+
+    def _dag(self, sentence):
+        dag = {}
+        n = len(sentence)
+        for start in range(n):
+            ends = []
+            end = start
+            fragment = sentence[start]
+            while end < n and fragment in self.freq:
+                if self.freq[fragment]:
+                    ends.append(end)
+                end += 1
+                fragment = sentence[start:end + 1]
+            dag[start] = ends or [start]
+        return dag
+
+    def _route(self, sentence, dag):
+        """从后往前动态规划，route[i] = (从 i 开始的最大对数概率, 该位置的词尾)"""
+        n = len(sentence)
+        log_total = math.log(self.total or 1)
+        route = {n: (0.0, 0)}
+        for start in range(n - 1, -1, -1):
+            route[start] = max(
+                (math.log(self.freq.get(sentence[start:end + 1]) or 1) - log_total + route[end + 1][0], end)
+                for end in dag[start]
+            )
+        return route
+
+    def cut(self, text):
+        """切分文本，返回词列表（标点和空白被丢弃）"""
+        words = []
+        for block in _blocks.findall(text):
+            if not _han.match(block):
+                words.append(block.lower())
+                continue
+            route = self._route(block, self._dag(block))
+            start = 0
+            unknown = ""
+            while start < len(block):
+                end = route[start][1] + 1
+                word = block[start:end]
+                if end - start == 1 and not self.freq.get(word):
+                    unknown += word
+                else:
+                    if unknown:
+                        words.append(unknown)
+                        unknown = ""
+                    words.append(word)
+                start = end
+            if unknown:
+                words.append(unknown)
+        return words
+
+
+class KeywordExtractor:
+    def __init__(self, dict_file=KEYWORD_DICT_FILE, stopwords_file=STOPWORDS_FILE, min_length=2):
+        self.segmenter = Segmenter(dict_file)
+        self.stopwords = set(_read_lines(stopwords_file))
+        self.min_length = min_length
+
+    def is_keyword(self, word):
+        return (
+            len(word) >= self.min_length
+            and word not in self.stopwords
+            and not word.isdigit()
+        )
+
+    def extract(self, text):
+        """提取一条消息的关键词（同一条消息里重复的词只算一次，保持出现顺序）"""
+        return list(dict.fromkeys(w for w in self.segmenter.cut(text) if self.is_keyword(w)))
+
+    def extract_batch(self, texts, workers=1):
+        """批量提取，用于历史数据回填
+
+        相同文本只切分一次（聊天里“晚安”“在吗”这类短句大量重复）；workers > 1 时分到多个进程
+        """
+        unique = list(dict.fromkeys(texts))
+        if workers > 1 and len(unique) > 1000:
+            chunk = max(1, len(unique) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(self.extract, unique, chunksize=chunk))
+        else:
+            results = [self.extract(text) for text in unique]
+        lookup = dict(zip(unique, results))
+        return [lookup[text] for text in texts]
+
+
+_extractor = None
+
+
+def get_extractor():
+    """进程内共享的关键词提取器（首次使用时加载词典）"""
+    global _extractor
+    if _extractor is None:
+        _extractor = KeywordExtractor()
+    return _extractor
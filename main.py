@@ -1,45 +1,51 @@
 # Main Telegram bot logic placeholder
 # main.py
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-import openai
-import json
-import os
-from elevenlabs import generate, set_api_key
-from stability_sdk import client
-import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
-from PIL import Image
-import io
-import tempfile
-
-from config import (
-    BOT_TOKEN, OPENAI_API_KEY, ELEVENLABS_API_KEY, STABILITY_API_KEY,
-    CHARACTER_FILE, GPT_MODEL, VOICE_MODEL, IMAGE_MODEL, DEFAULT_CHARACTER
-)
-from database import Database
-from emotion_analyzer import EmotionAnalyzer
-from personality_learner import PersonalityLearner
-
-# Initialize APIs and services
-openai.api_key = OPENAI_API_KEY
-set_api_key(ELEVENLABS_API_KEY)
-stability_api = client.StabilityInference(
-    key=STABILITY_API_KEY,
-    verbose=True
-)
-
-# Initialize services
-db = Database()
-emotion_analyzer = EmotionAnalyzer()
-personality_learner = PersonalityLearner()
-
-def load_prompt():
-    try:
-        with open(CHARACTER_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get("default", DEFAULT_CHARACTER)
-    except Exception:
-        return DEFAULT_CHARACTER
+import asyncio
+
+from startup import startup_timer
+
+with startup_timer.stage("导入 telegram"):
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+
+with startup_timer.stage("导入业务模块"):
+    from config import (
+        BOT_TOKEN, ELEVENLABS_API_KEY, EMOTION_MODE, REPLY_MODE, CHAT_DEADLINE, BOT_MODE, WEBHOOK_URL,
+        WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, WORKER_COUNT,
+        ARCHIVE_INTERVAL, ELEVENLABS_VOICE_ID, DEFAULT_CHARACTER, MEMORY_RECALL_TIMEOUT
+    )
+    from context_builder import ContextBuilder, message_tokens
+    from database import Database
+    from deadlines import UpstreamUnavailable, deadline, timeout_for
+    from emotion_analyzer import EmotionAnalyzer, STRUCTURED_REPLY_INSTRUCTION, template_lines
+    from history_archive import get_history_archive
+    from personality_learner import PersonalityLearner
+    from persona_registry import PersonaRegistry
+    from reply_stream import ReplyStream, split_message
+    from sharding import WorkerRouter
+    from image_jobs import ImageJobQueue
+    from metrics import metrics
+    from speech import SpeechSynthesizer
+    from update_processor import PerChatUpdateProcessor
+    import upstream
+
+# Initialize services（情感模型在启动后于后台加载，见 post_init）
+with startup_timer.stage("初始化数据库"):
+    db = Database()
+with startup_timer.stage("初始化情绪分析"):
+    emotion_analyzer = EmotionAnalyzer()
+with startup_timer.stage("初始化个性化学习"):
+    personality_learner = PersonalityLearner()
+with startup_timer.stage("加载角色"):
+    persona_registry = PersonaRegistry()
+context_builder = ContextBuilder(db)
+history_archive = get_history_archive()
+archive_task = None
+speech = SpeechSynthesizer()
+image_jobs = ImageJobQueue()
+
+# 合并模式会在上下文后追加输出格式要求，组装上下文时预留它的 token
+STRUCTURED_RESERVE = message_tokens(STRUCTURED_REPLY_INSTRUCTION) if EMOTION_MODE == "combined" else 0
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -93,16 +99,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer(settings_text)
     
     elif query.data == "show_profile":
+        await personality_learner.preload(user_id)
         profile = personality_learner.get_user_profile(user_id)
         profile_text = "主人，这是我对你的了解喵~：\n\n"
         
         # 添加兴趣信息
-        if profile["interests"]["keywords"]:
-            top_keywords = sorted(
-                profile["interests"]["keywords"].items(),
-                key=lambda x: x[1],
-                reverse=True
-            )[:5]
+        top_keywords = personality_learner.get_top_keywords(user_id, 5)
+        if top_keywords:
             profile_text += "主人最感兴趣的话题：\n"
             for keyword, count in top_keywords:
                 profile_text += f"- {keyword}（{count}次）\n"
@@ -117,44 +120,85 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
+    # 每条消息各阶段的耗时记入指标，开启 TRACE_LOG 时写出明细；
+    # 所有上游调用共用 CHAT_DEADLINE 的时间预算，超时的可选阶段直接跳过
+    with metrics.trace("chat", user_id=user.id), deadline(CHAT_DEADLINE):
+        await _chat(update, user)
+
+async def _chat(update, user):
     user_id = user.id
     user_input = update.message.text
     
     # Add user to database if not exists
     db.add_user(user_id, user.username, user.first_name, user.last_name)
     
-    # 情绪分析
-    emotion_data = emotion_analyzer.analyze_text(user_input)
-    emotional_response = emotion_analyzer.get_emotional_response(emotion_data)
-    
-    # 更新个性化学习
-    personality_learner.update_interests(user_id, user_input)
-    personality_learner.update_interaction_pattern(user_id, "chat")
-    personality_learner.update_preferences(user_id, {
-        "message": user_input,
-        "emotion": emotion_data
-    })
+    # 更新个性化学习（缓存未命中的统计先在写线程里读好，不让事件循环等写队列提交）
+    await personality_learner.preload(user_id)
+    with metrics.stage("learner"):
+        personality_learner.update_interests(user_id, user_input)
+        personality_learner.update_interaction_pattern(user_id, "chat")
     
-    # Get chat history from database
-    history = db.get_chat_history(user_id)
-    messages = [{"role": "system", "content": load_prompt()["personality"]}]
+    # 按用户设置选择角色（user_preferences.personality）
+    prefs = db.get_user_preferences(user_id)
+    persona = persona_registry.get(prefs[3] if prefs else None)
     
-    # 添加个性化提示
-    personalized_prompt = personality_learner.get_personalized_prompt(user_id)
-    if personalized_prompt:
-        messages.append({"role": "system", "content": personalized_prompt})
+    # 从长期记忆里召回相关的旧消息（向量检索在线程池里执行）；超时或出错时不带长期记忆继续
+    try:
+        with metrics.stage("memory_recall"):
+            memories = await asyncio.wait_for(
+                upstream.run_blocking(db.memory.recall, user_id, user_input), timeout_for(MEMORY_RECALL_TIMEOUT)
+            )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"召回长期记忆出错：{e!r}")
+        metrics.events.inc(event="memory_recall_skipped")
+        memories = []
     
-    for msg, role in reversed(history):
-        messages.append({"role": role, "content": msg})
-    messages.append({"role": "user", "content": user_input})
+    # 按 token 预算组装上下文：角色设定、个性化提示、滚动摘要、长期记忆和最近的对话
+    with metrics.stage("context_build"):
+        messages = context_builder.build(
+            user_id,
+            persona,
+            user_input,
+            personalized_prompt=personality_learner.get_personalized_prompt(user_id),
+            memories=memories,
+            reserve_tokens=STRUCTURED_RESERVE
+        )
     
     try:
-        # Get GPT response
-        response = openai.ChatCompletion.create(
-            model=GPT_MODEL,
-            messages=messages
-        )
-        reply = response.choices[0].message.content
+        # 流式模式下回复生成到一小段就先发出，之后节流地编辑成完整内容
+        stream = ReplyStream(update.message) if REPLY_MODE == "stream" else None
+        
+        # Get GPT response（合并模式下同一次补全顺带返回情绪）
+        if EMOTION_MODE == "combined":
+            on_partial = None
+            if stream:
+                async def on_partial(partial_reply, emotion_analysis):
+                    # 情绪字段在回复之前输出，正常情况下此时已能确定情绪回应
+                    if emotion_analysis is not None:
+                        prefix = emotion_analyzer.get_emotional_response({"emotion_analysis": emotion_analysis})
+                        partial_reply = f"{prefix}\n\n{partial_reply}"
+                    await stream.update(partial_reply)
+            # 补全的耗时（不含编辑 Telegram 消息）在 upstream 里记为 completion 阶段
+            reply, emotion_data = await emotion_analyzer.reply_with_emotion(messages, user_input, on_partial)
+            emotional_response = emotion_analyzer.get_emotional_response(emotion_data)
+        else:
+            emotion_data = await emotion_analyzer.analyze_text(user_input)
+            emotional_response = emotion_analyzer.get_emotional_response(emotion_data)
+            if stream:
+                reply = await upstream.stream_chat_completion(
+                    messages, lambda partial_reply: stream.update(f"{emotional_response}\n\n{partial_reply}"),
+                    stage="completion"
+                )
+            else:
+                reply = await upstream.chat_completion(messages, stage="completion")
+        
+        with metrics.stage("learner"):
+            personality_learner.update_preferences(user_id, {
+                "message": user_input,
+                "emotion": emotion_data
+            })
         
         # 添加情绪回应
         reply = f"{emotional_response}\n\n{reply}"
@@ -164,55 +208,157 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.add_message(user_id, reply, "assistant")
         
         # Send text response
-        await update.message.reply_text(reply)
-        
-        # Generate and send voice if enabled
-        prefs = db.get_user_preferences(user_id)
-        if prefs and prefs[1]:  # voice_enabled
-            audio = generate(
-                text=reply,
-                voice=VOICE_MODEL,
-                model="eleven_multilingual_v2"
-            )
-            await update.message.reply_voice(
-                voice=audio,
-                filename="response.mp3"
-            )
+        if stream:
+            await stream.finish(reply)
+        else:
+            for chunk in split_message(reply):
+                with metrics.stage("telegram_send"):
+                    await update.message.reply_text(chunk)
         
-        # Generate and send image if enabled
-        if prefs and prefs[2]:  # image_enabled
+        # Generate and send image if enabled（放进后台队列，不等生成完成；Stability 熔断时跳过）
+        if prefs and prefs[2] and upstream.available("stability"):  # image_enabled
             image_prompt = f"cute anime cat girl: {reply[:100]}"
-            answers = stability_api.generate(
-                prompt=image_prompt,
-                seed=42,
-                steps=30,
-                cfg_scale=7.0,
-                width=512,
-                height=512,
-                samples=1,
-                sampler=generation.SAMPLER_K_DPMPP_2M
-            )
+            message = update.message
+            
+            async def send_images(images):
+                for binary in images:
+                    with metrics.stage("telegram_send_photo"):
+                        await message.reply_photo(photo=binary, caption="这是为你生成的图片喵~")
             
-            for resp in answers:
-                for artifact in resp.artifacts:
-                    if artifact.type == generation.ARTIFACT_IMAGE:
-                        img = Image.open(io.BytesIO(artifact.binary))
-                        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                            img.save(tmp.name)
-                            await update.message.reply_photo(
-                                photo=open(tmp.name, 'rb'),
-                                caption="这是为你生成的图片喵~"
-                            )
-                        os.unlink(tmp.name)
+            if not image_jobs.submit(user_id, image_prompt, send_images):
+                metrics.events.inc(event="image_dropped")
+                print("⚠️ 生图队列已满，跳过本次生图")
+        
+        # Generate and send voice if enabled（文字已经发出，语音失败或超时只跳过语音）
+        if prefs and prefs[1]:  # voice_enabled
+            try:
+                with metrics.stage("tts"):
+                    audio = await speech.synthesize(reply, persona["voice_id"])
+                with metrics.stage("telegram_send_voice"):
+                    await update.message.reply_voice(
+                        voice=audio,
+                        filename="response.mp3"
+                    )
+            except Exception as e:
+                print(f"⚠️ 跳过语音：{e}")
+                metrics.events.inc(event="voice_skipped")
                         
+    except UpstreamUnavailable as e:
+        print("⚠️ 上游不可用：", e)
+        metrics.record_error(e)
+        metrics.events.inc(event="chat_unavailable")
+        await update.message.reply_text("呜呜我现在有点反应不过来，主人等一下再跟我说话好不好喵~")
     except Exception as e:
         print("❌ 出错：", e)
+        metrics.record_error(e)
+        metrics.events.inc(event="chat_failed")
         await update.message.reply_text("呜呜出错了喵~")
 
+async def warm_up_models():
+    try:
+        seconds = await emotion_analyzer.warm_up()
+    except Exception:
+        print("⚠️ 情感模型不可用，继续以降级模式运行")
+        return
+    startup_timer.record("加载情感模型（后台）", seconds)
+    startup_timer.report("启动耗时（模型就绪）")
+
+async def prewarm_speech():
+    # 每条回复开头的固定情绪回应预先合成好，之后直接读缓存
+    voice_ids = {persona_registry.get(name)["voice_id"] for name in persona_registry.names()}
+    if not ELEVENLABS_VOICE_ID:
+        # 没配置默认声音时只是占位符，合成出来也用不上
+        voice_ids.discard(DEFAULT_CHARACTER["voice_id"])
+    if not voice_ids:
+        print("未配置 ELEVENLABS_VOICE_ID，跳过预先合成语音")
+        return
+    synthesized = await speech.prewarm(template_lines(), voice_ids)
+    if synthesized:
+        print(f"已预先合成 {synthesized} 句固定回应的语音")
+
+async def compact_history(shards=None):
+    # 每隔 ARCHIVE_INTERVAL 秒把一批用户的旧对话移进归档段；多进程部署时只处理自己负责的分片。
+    # 顺带清理情绪缓存持久化文件里过期和超出上限的结果（排进它自己的写队列，不等待）
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        emotion_analyzer.cache.prune()
+        try:
+            await upstream.run_background(history_archive.compact_step, shards)
+        except Exception as e:
+            metrics.record_error(e)
+            print(f"⚠️ 归档聊天记录出错：{e}")
+
+def register_metric_collectors(processor, router=None):
+    # 抓取 /metrics 时读取各缓存和队列的统计
+    metrics.register_collector("emotion_cache", emotion_analyzer.cache.stats)
+    metrics.register_collector("emotion_lexicon", emotion_analyzer.lexicon.stats)
+    metrics.register_collector("user_cache", db.cache.stats)
+    metrics.register_collector("audio_cache", speech.stats)
+    metrics.register_collector("image_jobs", image_jobs.stats)
+    metrics.register_collector("updates", processor.stats)
+    metrics.register_collector("breakers", upstream.breaker_stats)
+    metrics.register_collector("history_archive", history_archive.stats)
+    if router is not None:
+        metrics.register_collector("worker", router.stats)
+
+async def start_background_warmup(app):
+    await metrics.serve()
+    image_jobs.start()
+    global archive_task
+    if ARCHIVE_INTERVAL:
+        archive_task = asyncio.create_task(compact_history(app.bot_data.get("archive_shards")))
+    # 预热期间到达的消息走降级路径，不等待模型
+    app.bot_data["warmup_task"] = asyncio.create_task(warm_up_models())
+    app.bot_data["memory_warmup_task"] = asyncio.create_task(upstream.run_blocking(db.memory.warm_up))
+    if ELEVENLABS_API_KEY:
+        app.bot_data["speech_prewarm_task"] = asyncio.create_task(prewarm_speech())
+    startup_timer.report("启动耗时（开始接收消息）")
+
+async def shutdown_clients(app):
+    if archive_task is not None:
+        archive_task.cancel()
+        await asyncio.gather(archive_task, return_exceptions=True)
+    await metrics.close()
+    await image_jobs.close()
+    await context_builder.close()
+    await emotion_analyzer.close()
+    await upstream.close()
+    # 提交内存中的计数和写队列中剩余的写入
+    personality_learner.close()
+    db.close()
+
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # 多个工作进程按分片分担用户，只能用 webhook 模式（Telegram 不允许多个进程同时拉取更新）
+    router = None
+    if WORKER_COUNT > 1:
+        if BOT_MODE != "webhook":
+            raise SystemExit("WORKER_COUNT > 1 时需要 BOT_MODE=webhook")
+        router = WorkerRouter(db.storage)
+        print(f"工作进程 {router.index}/{router.workers}，负责分片 {router.owned_shards()}")
+    processor = PerChatUpdateProcessor(router=router)
+    register_metric_collectors(processor, router)
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # 不同会话并发处理，同一会话按顺序处理
+        .concurrent_updates(processor)
+        .post_init(start_background_warmup)
+        .post_shutdown(shutdown_clients)
+        .build()
+    )
+    app.bot_data["archive_shards"] = router.owned_shards() if router else None
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
     print("✅ AI 女友上线喵~")
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        app.run_polling()
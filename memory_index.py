@@ -0,0 +1,254 @@
+# 长期记忆：主人说过的话的本地向量索引
+# 用词典分词 + 特征哈希（HashingVectorizer，带符号的哈希本身就是一种随机投影）把消息映射成定长的单位向量，
+# 每个用户两个只追加的文件：<user_id>.<维数>.vec（float32 矩阵）和 <user_id>.<维数>.ids（对应的 chat_history.id），
+# 查询时内存映射后做一次矩阵-向量乘法得到余弦相似度，取前 k 条。完全离线，不调用任何接口。
+# numpy 和 scikit-learn 导入较慢，第一次用到时才导入（启动后在后台预热，见 warm_up）
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from config import (
+    MEMORY_DIR, MEMORY_DIM, MEMORY_TOP_K, MEMORY_MIN_SCORE, MEMORY_SKIP_RECENT, MEMORY_OPEN_USERS
+)
+from history_archive import HistoryArchive, get_history_archive
+from keyword_extractor import get_extractor
+from storage import get_storage
+
+_han = re.compile(r"[\u4e00-\u9fff]")
+
+
+class MemoryIndex:
+    def __init__(self, directory=MEMORY_DIR, dim=MEMORY_DIM, storage=None, max_open=MEMORY_OPEN_USERS,
+                 archive=None):
+        self.directory = directory
+        self.dim = dim
+        self.storage = storage or get_storage()
+        # 较早的消息已移进归档段，召回和重建时从归档里读
+        self.archive = archive or (HistoryArchive(self.storage) if storage else get_history_archive())
+        self.max_open = max_open
+        os.makedirs(directory, exist_ok=True)
+        self._extractor = get_extractor()
+        self._vectorizer = None
+        self._maps = OrderedDict()  # user_id -> (行数, 向量矩阵, id 数组)，按用户 LRU 保留
+        self._locks = {}
+        self._lock = threading.Lock()
+        # 同一条消息查询和写入索引时各算一次向量，缓存最近的结果
+        self.embed = lru_cache(maxsize=1024)(self._embed)
+
+    def _features(self, text):
+        """分词后去掉停用词和纯数字，单字也保留（短消息里常常就是关键信息）；
+        多字词再拆出单字，“猫咪”和“猫”这类切分不同的说法也能匹配上"""
+        extractor = self._extractor
+        features = []
+        for word in extractor.segmenter.cut(text):
+            if word in extractor.stopwords or word.isdigit():
+                continue
+            features.append(word)
+            if len(word) > 1 and _han.match(word):
+                features.extend(word)
+        return features
+
+    def _get_vectorizer(self):
+        if self._vectorizer is None:
+            from sklearn.feature_extraction.text import HashingVectorizer
+            self._vectorizer = HashingVectorizer(
+                n_features=self.dim, analyzer=self._features, alternate_sign=True, norm="l2"
+            )
+        return self._vectorizer
+
+    def warm_up(self):
+        """导入 numpy 和 scikit-learn，避免第一条消息在事件循环里等待导入"""
+        self._get_vectorizer()
+
+    def _vectorize(self, texts):
+        import numpy as np
+        return self._get_vectorizer().transform(texts).toarray().astype(np.float32)
+
+    def _embed(self, text):
+        """消息的单位向量，没有可用特征时返回 None"""
+        vector = self._vectorize([text])[0]
+        return vector if vector.any() else None
+
+    def _paths(self, user_id):
+        # 文件名带上维数：改了 MEMORY_DIM 而没有重建时查不到旧向量，而不是按错误的维数读取
+        base = os.path.join(self.directory, f"{user_id}.{self.dim}")
+        return base + ".vec", base + ".ids"
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            lock = self._locks.get(user_id)
+            if lock is None:
+                lock = self._locks[user_id] = threading.Lock()
+            return lock
+
+    # ---- 写 ----
+
+    def append(self, user_id, row_id, vector):
+        """追加一条消息的向量（在存储层的写线程里调用，和消息写入同一个事务）"""
+        if vector is None:
+            return
+        import numpy as np
+        vec_path, ids_path = self._paths(user_id)
+        with self._user_lock(user_id):
+            # 先写 id 再写向量，两次写之间崩溃会让 .ids 多出一行（或留下写了一半的行），
+            # 之后再追加 id 和向量就错开了：追加前先把两个文件截到相同的完整行数
+            rows = self._rows(vec_path, ids_path)
+            for path, size in ((vec_path, rows * self.dim * 4), (ids_path, rows * 8)):
+                if os.path.exists(path) and os.path.getsize(path) != size:
+                    os.truncate(path, size)
+            with open(ids_path, "ab") as f:
+                f.write(np.int64(row_id).tobytes())
+            with open(vec_path, "ab") as f:
+                f.write(vector.tobytes())
+
+    def _rows(self, vec_path, ids_path):
+        """两个文件里都完整的行数"""
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (vec_path, ids_path)]
+        return min(sizes[0] // (self.dim * 4), sizes[1] // 8)
+
+    # ---- 读 ----
+
+    def _mapped(self, user_id):
+        """内存映射的 (向量矩阵, id 数组)，文件有新增时重新映射"""
+        import numpy as np
+        vec_path, ids_path = self._paths(user_id)
+        with self._user_lock(user_id):
+            rows = self._rows(vec_path, ids_path)
+            if rows == 0:
+                return None
+            cached = self._maps.get(user_id)
+            if cached is not None and cached[0] == rows:
+                self._maps.move_to_end(user_id)
+                return cached[1], cached[2]
+            vectors = np.memmap(vec_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            ids = np.memmap(ids_path, dtype=np.int64, mode="r", shape=(rows,))
+            self._maps[user_id] = (rows, vectors, ids)
+            self._maps.move_to_end(user_id)
+            if len(self._maps) > self.max_open:
+                self._maps.popitem(last=False)
+            return vectors, ids
+
+    def search(self, user_id, text, k=MEMORY_TOP_K, skip_recent=MEMORY_SKIP_RECENT, min_score=MEMORY_MIN_SCORE):
+        """与 text 最相关的 k 条旧消息 [(chat_history.id, 相似度)]，最近 skip_recent 条不参与"""
+        query = self.embed(text)
+        mapped = self._mapped(user_id)
+        if query is None or mapped is None:
+            return []
+        import numpy as np
+        vectors, ids = mapped
+        rows = len(ids) - skip_recent
+        if rows <= 0:
+            return []
+        # 向量都已归一化，点积即余弦相似度
+        scores = vectors[:rows] @ query
+        if rows > k:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(rows)
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+    def recall(self, user_id, text, k=MEMORY_TOP_K):
+        """与 text 相关的旧消息原文，按相关度排序（相同内容只保留一条）"""
+        hits = self.search(user_id, text, k)
+        if not hits:
+            return []
+        ids = [row_id for row_id, _ in hits]
+        rows = dict(self.storage.for_user(user_id).query(f'''
+        SELECT id, message FROM chat_history
+        WHERE id IN ({", ".join("?" for _ in ids)})
+        ''', ids))
+        missing = [row_id for row_id in ids if row_id not in rows]
+        if missing:
+            rows.update(self.archive.messages(user_id, missing))
+        return list(dict.fromkeys(rows[row_id] for row_id in ids if rows.get(row_id) and rows[row_id] != text))
+
+    # ---- 回填 ----
+
+    def _index_rows(self, rows):
+        """rows: [(chat_history.id, user_id, message)]，按 id 顺序"""
+        vectors = self._vectorize([row[2] or "" for row in rows])
+        for (row_id, user_id, _), vector in zip(rows, vectors):
+            if vector.any():
+                self.append(user_id, row_id, vector)
+
+    def _remove_files(self, user_id):
+        with self._lock:
+            self._maps.pop(user_id, None)
+        for path in self._paths(user_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def rebuild(self, batch_size=5000):
+        """用主人的全部消息（含归档）重建索引（逐个分片扫描），返回处理的消息数"""
+        self.storage.flush()
+        with self._lock:
+            self._maps.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith((".vec", ".ids")):
+                os.remove(os.path.join(self.directory, name))
+
+        total = 0
+        for storage in self.storage.all():
+            # 同一用户归档的消息都比 chat_history 里的早，先索引归档，向量仍按 id 顺序追加
+            batch = []
+            for row_id, user_id, message, _ in self.archive.scan(storage, role="user"):
+                batch.append((row_id, user_id, message))
+                if len(batch) >= batch_size:
+                    self._index_rows(batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                self._index_rows(batch)
+                total += len(batch)
+            last_id = 0
+            while True:
+                rows = storage.query('''
+                SELECT id, user_id, message FROM chat_history
+                WHERE role = 'user' AND id > ?
+                ORDER BY id
+                LIMIT ?
+                ''', (last_id, batch_size))
+                if not rows:
+                    break
+                self._index_rows(rows)
+                last_id = rows[-1][0]
+                total += len(rows)
+        return total
+
+    def rebuild_user(self, user_id):
+        """只重建一个用户的索引（消息的 id 变化后，如迁移到其他分片），返回处理的消息数"""
+        storage = self.storage.for_user(user_id)
+        storage.flush()
+        self._remove_files(user_id)
+        archived = [(row_id, user_id, message)
+                    for row_id, message, _, _ in self.archive.read(user_id, role="user", storage=storage)]
+        rows = archived + storage.query('''
+        SELECT id, user_id, message FROM chat_history
+        WHERE user_id = ? AND role = 'user'
+        ORDER BY id
+        ''', (user_id,))
+        if rows:
+            self._index_rows(rows)
+        return len(rows)
+
+
+_index = None
+
+
+def get_memory_index():
+    """进程内共享的长期记忆索引"""
+    global _index
+    if _index is None:
+        _index = MemoryIndex()
+    return _index
+
+
+if __name__ == "__main__":
+    # python memory_index.py：用已有的聊天记录建立（或重建）长期记忆索引
+    from database import Database
+    db = Database()
+    print(f"已为 {db.memory.rebuild()} 条消息建立索引")
+    db.close()
@@ -0,0 +1,290 @@
+# 聊天流程的分阶段计时和指标
+# 各阶段（情感模型、情绪 GPT、学习更新、数据库读写、补全、语音、生图、Telegram 发送）的耗时记入直方图，
+# token 用量、错误数等记入计数器，各缓存的命中率在抓取时从 stats() 读取。
+# METRICS_PORT 不为 0 时在本地提供 Prometheus 文本格式的 /metrics；
+# TRACE_LOG 不为空时，每条消息各阶段的耗时按 JSON 行写入该文件（只记录总耗时不低于 TRACE_SLOW_MS 的）
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from config import METRICS_HOST, METRICS_PORT, TRACE_LOG, TRACE_SLOW_MS
+
+PREFIX = "ai_lover"
+# 秒；覆盖从本地缓存命中到生图的范围
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, lock):
+        self.name = name
+        self.help = help_text
+        self._lock = lock
+        self._values = defaultdict(float)  # 标签 -> 值
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, lock, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self._lock = lock
+        self.buckets = tuple(buckets)
+        self._series = {}  # 标签 -> [各桶计数..., 总和, 总数]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            index = bisect_left(self.buckets, value)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(sorted(labels.items())))
+        return series[-1] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), series):
+                cumulative += n
+                bucket_labels = labels + (("le", _number(bound)),)
+                lines.append(f"{self.name}_bucket{_labels_text(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(labels)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels_text(labels)} {series[-1]}")
+        return lines
+
+
+class Trace:
+    """一条消息的处理记录：各阶段相对开始时刻的偏移和耗时"""
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.start = time.perf_counter()
+        self.spans = []
+        self.error = None
+
+    def add(self, stage, started, seconds, ok):
+        self.spans.append({
+            "stage": stage,
+            "offset_ms": round((started - self.start) * 1000, 2),
+            "ms": round(seconds * 1000, 2),
+            **({} if ok else {"error": True})
+        })
+
+    def to_dict(self, total):
+        return {
+            "trace": self.name,
+            "time": time.time(),
+            **self.fields,
+            "total_ms": round(total * 1000, 2),
+            **({"error": self.error} if self.error else {}),
+            "stages": self.spans
+        }
+
+
+class Metrics:
+    def __init__(self, trace_log=TRACE_LOG, trace_slow_ms=TRACE_SLOW_MS):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []  # (名字, 返回 dict 的函数)
+        self.trace_log = trace_log
+        self.trace_slow = trace_slow_ms / 1000
+        self._trace_lock = threading.Lock()
+        self._server = None
+
+        self.stage_seconds = self.histogram("stage_seconds", "各处理阶段的耗时（秒）")
+        self.stage_errors = self.counter("stage_errors_total", "各处理阶段抛出异常的次数")
+        self.tokens = self.counter("openai_tokens_total", "OpenAI 补全的 token 用量")
+        self.events = self.counter("events_total", "其他事件计数（降级、丢弃等）")
+
+    def counter(self, name, help_text):
+        return self._register(Counter(f"{PREFIX}_{name}", help_text, self._lock))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(f"{PREFIX}_{name}", help_text, self._lock, buckets))
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, name, stats):
+        """抓取时调用 stats()，把返回的数值（可以嵌套一层按标签分组的 dict）导出为 gauge"""
+        self._collectors = [c for c in self._collectors if c[0] != name] + [(name, stats)]
+
+    # ---- 记录 ----
+
+    def observe(self, stage, seconds, ok=True):
+        self.stage_seconds.observe(seconds, stage=stage)
+        if not ok:
+            self.stage_errors.inc(stage=stage)
+
+    @contextmanager
+    def stage(self, name):
+        """记录一个阶段的耗时；在 trace() 里时同时记入当前消息的处理记录（同步和异步代码都可以用）"""
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds, ok)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add(name, start, seconds, ok)
+
+    @contextmanager
+    def trace(self, name, **fields):
+        """一条消息的完整处理：总耗时记为阶段 name，开启 TRACE_LOG 时写出各阶段明细"""
+        trace = Trace(name, **fields)
+        token = _current_trace.set(trace)
+        ok = False
+        try:
+            yield trace
+            ok = True
+        except BaseException as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            _current_trace.reset(token)
+            total = time.perf_counter() - trace.start
+            self.observe(name, total, ok and trace.error is None)
+            if self.trace_log and total >= self.trace_slow:
+                self._write_trace(trace.to_dict(total))
+
+    def record_error(self, error):
+        """当前消息被降级处理时记下原因（异常已在调用方处理）"""
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.error = repr(error)
+
+    def count_tokens(self, prompt_tokens, completion_tokens):
+        self.tokens.inc(prompt_tokens, kind="prompt")
+        self.tokens.inc(completion_tokens, kind="completion")
+
+    def _write_trace(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        try:
+            with self._trace_lock, open(self.trace_log, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"写入处理记录出错：{e}")
+
+    # ---- 导出 ----
+
+    def _collected(self):
+        families = defaultdict(list)  # 指标名 -> [(标签, 值)]，同名的行要连在一起输出
+        for name, stats in self._collectors:
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"读取 {name} 统计出错：{e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, dict):
+                    # 嵌套一层：{标签值: {指标: 值}}，如用户缓存按字段的命中率
+                    for label, inner in sorted(value.items()):
+                        if not isinstance(inner, dict):
+                            continue
+                        for inner_key, inner_value in inner.items():
+                            if isinstance(inner_value, (int, float)):
+                                families[f"{PREFIX}_{name}_{inner_key}"].append((((key, label),), inner_value))
+                elif isinstance(value, (int, float)):
+                    families[f"{PREFIX}_{name}_{key}"].append(((), value))
+        lines = []
+        for metric, samples in families.items():
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(f"{metric}{_labels_text(labels)} {_number(value)}" for labels, value in samples)
+        return lines
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            with self._lock:
+                lines.extend(metric.render())
+        lines.extend(self._collected())
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # 读完请求头，内容不需要
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", "not found\n"
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        """在本地启动 /metrics 服务；port 为 0 时不启动"""
+        if not port or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, host, port)
+        print(f"📈 指标地址：http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics = Metrics()
@@ -0,0 +1,108 @@
+# 角色（人设）注册表
+# characters.json 和 role_prompts/ 只在启动和文件修改时间变化时读取，
+# 每个角色的 system 消息和 token 数预先算好，聊天时按用户偏好直接取用，不再每条消息读文件
+import json
+import os
+import time
+
+from config import CHARACTER_FILE, ROLE_PROMPTS_DIR, PERSONA_CHECK_SECONDS, DEFAULT_CHARACTER
+from token_counter import count_message_tokens
+
+DEFAULT_PERSONA = "default"
+
+
+def _default_prompt():
+    c = DEFAULT_CHARACTER
+    return f"你是{c['name']}，{c['personality']}。{c['speaking_style']}。{c['background']}。"
+
+
+class PersonaRegistry:
+    def __init__(self, character_file=CHARACTER_FILE, prompt_dir=ROLE_PROMPTS_DIR, check_seconds=PERSONA_CHECK_SECONDS):
+        self.character_file = character_file
+        self.prompt_dir = prompt_dir
+        self.check_seconds = check_seconds
+        self._personas = {}
+        self._mtimes = {}
+        self._next_check = 0.0
+        self.reload()
+
+    def _sources(self):
+        """当前所有角色文件及其修改时间"""
+        paths = [self.character_file]
+        if os.path.isdir(self.prompt_dir):
+            paths.extend(
+                os.path.join(self.prompt_dir, name)
+                for name in sorted(os.listdir(self.prompt_dir))
+                if name.endswith(".txt") and name != "README.txt"
+            )
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+        return mtimes
+
+    def _build(self, name, prompt, voice_id=None):
+        system_message = {"role": "system", "content": prompt}
+        return {
+            "name": name,
+            "prompt": prompt,
+            "system_message": system_message,
+            "tokens": count_message_tokens(system_message),
+            "voice_id": voice_id or DEFAULT_CHARACTER["voice_id"]
+        }
+
+    def reload(self):
+        mtimes = self._sources()
+        personas = {DEFAULT_PERSONA: self._build(DEFAULT_PERSONA, _default_prompt())}
+
+        if self.character_file in mtimes:
+            try:
+                with open(self.character_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                # 值可以是提示词字符串，也可以是 {"prompt": ..., "voice_id": ...}
+                for name, value in data.items():
+                    if isinstance(value, dict):
+                        prompt = value.get("prompt") or value.get("personality")
+                        if prompt:
+                            personas[name] = self._build(name, prompt, value.get("voice_id"))
+                    elif isinstance(value, str) and value.strip():
+                        personas[name] = self._build(name, value.strip())
+            except (OSError, ValueError) as e:
+                print(f"读取角色文件 {self.character_file} 出错：{e}")
+
+        # role_prompts/ 下每个 .txt 是一个角色，文件名即角色名
+        for path in mtimes:
+            if path == self.character_file:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    prompt = f.read().strip()
+            except OSError as e:
+                print(f"读取角色文件 {path} 出错：{e}")
+                continue
+            if prompt:
+                name = os.path.splitext(os.path.basename(path))[0]
+                personas[name] = self._build(name, prompt)
+
+        self._personas = personas
+        self._mtimes = mtimes
+        self._next_check = time.monotonic() + self.check_seconds
+
+    def _maybe_reload(self):
+        if time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + self.check_seconds
+        if self._sources() != self._mtimes:
+            print("角色文件有更新，重新加载")
+            self.reload()
+
+    def get(self, name=None):
+        """按名字取角色，不存在时返回默认角色"""
+        self._maybe_reload()
+        return self._personas.get(name or DEFAULT_PERSONA) or self._personas[DEFAULT_PERSONA]
+
+    def names(self):
+        self._maybe_reload()
+        return list(self._personas)
@@ -1,26 +1,74 @@
+import asyncio
 import json
+import time
+from collections import Counter, OrderedDict, defaultdict
 from datetime import datetime
-from config import DATABASE_FILE
-import sqlite3
-import numpy as np
+from config import (
+    LEARNER_FLUSH_SECONDS, PROFILE_TOP_KEYWORDS, KEYWORD_SKETCH_CAPACITY,
+    KEYWORD_HALF_LIFE_DAYS, KEYWORD_SKETCH_USERS
+)
+from heavy_hitters import SpaceSaving
+from history_archive import HistoryArchive, get_history_archive
+from keyword_extractor import get_extractor
+from storage import get_storage
+from user_cache import get_user_cache
+
+_MISSING = object()
+
+_KEYWORD_ROWS = f'''
+SELECT keyword, count, error, last_updated FROM user_keyword_counts
+WHERE user_id = ?
+ORDER BY count DESC
+LIMIT {KEYWORD_SKETCH_CAPACITY}
+'''
+_TIME_ROWS = 'SELECT time_period, count FROM user_time_counts WHERE user_id = ?'
+_PATTERN_ROWS = '''
+SELECT pattern_type, frequency
+FROM interaction_patterns
+WHERE user_id = ?
+ORDER BY frequency DESC
+'''
 
 class PersonalityLearner:
-    def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_FILE)
-        self.create_tables()
+    def __init__(self, storage=None, cache=None, archive=None):
+        # 与 Database 共用同一个存储层；读-改-写放在写线程里整体执行，不会互相覆盖
+        self.storage = storage or get_storage()
+        # 重建兴趣时也统计已归档的旧消息
+        self.archive = archive or (HistoryArchive(self.storage) if storage else get_history_archive())
+        # 时段计数、互动模式和渲染好的个性化提示按用户缓存，更新时同步更新或失效
+        self.cache = cache or get_user_cache()
+        self.storage.ensure_schema(self.create_tables)
+        # 每个用户的关键词用固定容量的 Space-Saving 统计，内存里按用户 LRU 保留
+        self._sketches = OrderedDict()
+        self._dirty_sketches = set()
+        # 热点计数先在内存里聚合，每 LEARNER_FLUSH_SECONDS 秒批量写入一次
+        self._pending_times = defaultdict(Counter)
+        self._last_flush = time.monotonic()
+        # 正在后台读取的用户 -> (读取任务, 读取排队之后写出的增量)，见 preload
+        self._loading = {}
         
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    def create_tables(self, conn):
+        cursor = conn.cursor()
         
-        # 创建用户兴趣表
+        # 创建用户兴趣计数表（每个关键词一行，原子自增）
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_interests (
-            user_id INTEGER PRIMARY KEY,
-            interests TEXT,
+        CREATE TABLE IF NOT EXISTS user_keyword_counts (
+            user_id INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
             last_updated TIMESTAMP,
+            PRIMARY KEY (user_id, keyword),
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
         ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_keyword_counts_top
+        ON user_keyword_counts (user_id, count DESC)
+        ''')
+        # Space-Saving 的计数误差上界
+        cursor.execute('PRAGMA table_info(user_keyword_counts)')
+        if "error" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE user_keyword_counts ADD COLUMN error REAL NOT NULL DEFAULT 0')
         
         # 创建用户互动模式表
         cursor.execute('''
@@ -33,85 +81,313 @@ class PersonalityLearner:
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
         ''')
+        # update_interaction_pattern 的 ON CONFLICT 依赖这个唯一索引
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_interaction_patterns_user_type
+        ON interaction_patterns (user_id, pattern_type)
+        ''')
         
-        # 创建用户偏好表
+        # 创建用户聊天时段计数表
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_preferences_learned (
-            user_id INTEGER PRIMARY KEY,
-            preferred_topics TEXT,
-            preferred_style TEXT,
-            preferred_time TEXT,
+        CREATE TABLE IF NOT EXISTS user_time_counts (
+            user_id INTEGER NOT NULL,
+            time_period TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
             last_updated TIMESTAMP,
+            PRIMARY KEY (user_id, time_period),
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
         ''')
         
-        self.conn.commit()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP
+        )
+        ''')
+        self._migrate_json_blobs(cursor)
+        self._trim_keyword_counts(cursor)
+    
+    def _trim_keyword_counts(self, cursor):
+        """一次性迁移：每个用户只保留计数最高的 KEYWORD_SKETCH_CAPACITY 个关键词"""
+        cursor.execute("SELECT 1 FROM schema_migrations WHERE name = 'keyword_sketch'")
+        if cursor.fetchone():
+            return
+        cursor.execute('''
+        DELETE FROM user_keyword_counts WHERE rowid IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY count DESC) AS rank
+                FROM user_keyword_counts
+            ) WHERE rank > ?
+        )
+        ''', (KEYWORD_SKETCH_CAPACITY,))
+        if cursor.rowcount > 0:
+            print(f"已清理 {cursor.rowcount} 条低频关键词计数")
+        cursor.execute(
+            "INSERT INTO schema_migrations (name, applied_at) VALUES ('keyword_sketch', ?)",
+            (datetime.now(),)
+        )
+    
+    def _migrate_json_blobs(self, cursor):
+        """一次性迁移：把旧的 JSON 兴趣/偏好整块数据拆成计数行
+
+        旧表 user_interests、user_preferences_learned 原样保留作备份
+        """
+        cursor.execute("SELECT 1 FROM schema_migrations WHERE name = 'counter_tables'")
+        if cursor.fetchone():
+            return
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in cursor.fetchall()}
+        
+        keyword_rows = []
+        if "user_interests" in tables:
+            cursor.execute('SELECT user_id, interests, last_updated FROM user_interests')
+            for user_id, interests, last_updated in cursor.fetchall():
+                keywords = json.loads(interests or "{}").get("keywords", {})
+                keyword_rows.extend((user_id, k, n, last_updated) for k, n in keywords.items())
+        
+        time_rows = []
+        if "user_preferences_learned" in tables:
+            cursor.execute('SELECT user_id, preferred_time, last_updated FROM user_preferences_learned')
+            for user_id, preferred_time, last_updated in cursor.fetchall():
+                periods = json.loads(preferred_time or "{}")
+                time_rows.extend((user_id, p, n, last_updated) for p, n in periods.items())
+        
+        cursor.executemany('''
+        INSERT INTO user_keyword_counts (user_id, keyword, count, last_updated)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, keyword) DO UPDATE SET count = count + excluded.count
+        ''', keyword_rows)
+        cursor.executemany('''
+        INSERT INTO user_time_counts (user_id, time_period, count, last_updated)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, time_period) DO UPDATE SET count = count + excluded.count
+        ''', time_rows)
+        cursor.execute(
+            "INSERT INTO schema_migrations (name, applied_at) VALUES ('counter_tables', ?)",
+            (datetime.now(),)
+        )
+        if keyword_rows or time_rows:
+            print(f"已迁移 {len(keyword_rows)} 条兴趣计数、{len(time_rows)} 条时段计数")
     
     def update_interests(self, user_id, message):
-        """更新用户兴趣"""
-        cursor = self.conn.cursor()
+        """更新用户兴趣（在内存的固定容量统计里累加，定期写入变化的部分）"""
+        sketch = self._sketch(user_id)
+        now = time.time()
+        top_before = [k for k, _ in sketch.top(3, now=now)]
+        for keyword in self._extract_keywords(message):
+            sketch.add(keyword, now=now)
+        self._dirty_sketches.add(user_id)
+        # 前三的关键词变了，个性化提示才需要重新生成
+        if [k for k, _ in sketch.top(3, now=now)] != top_before:
+            self.cache.invalidate(user_id, "prompt")
+        self._maybe_flush()
+    
+    async def preload(self, user_id):
+        """把用户的关键词统计、时段计数和互动模式读进内存，之后的同步调用都命中缓存
+
+        读取排进写队列，在此前排队的写入之后执行，事件循环不用等写队列提交；
+        读取排队之后才写出的计数（定期刷新、互动模式自增）记在增量里，读完一起合并
+        """
+        loading = self._loading.get(user_id)
+        if loading is None:
+            if (user_id in self._sketches
+                    and self.cache.peek(user_id, "time_counts", _MISSING) is not _MISSING
+                    and self.cache.peek(user_id, "patterns", _MISSING) is not _MISSING):
+                return
+            # 排队和登记增量在同一步里完成，中间不会有其他写入插进来
+            future = self.storage.for_user(user_id).submit(lambda conn: self._read_user(conn, user_id))
+            deltas = {"time_counts": Counter(), "patterns": Counter(), "sketch_stale": False}
+            task = asyncio.create_task(self._finish_preload(user_id, future, deltas))
+            loading = self._loading[user_id] = (task, deltas)
+        await asyncio.shield(loading[0])
+    
+    def _read_user(self, conn, user_id):
+        return tuple(
+            conn.execute(sql, (user_id,)).fetchall() for sql in (_KEYWORD_ROWS, _TIME_ROWS, _PATTERN_ROWS)
+        )
+    
+    async def _finish_preload(self, user_id, future, deltas):
+        try:
+            keyword_rows, time_rows, pattern_rows = await asyncio.wrap_future(future)
+        finally:
+            del self._loading[user_id]
+        # 读取期间这个用户的统计被换出过，读到的可能比换出时写的旧，留给同步路径重新读
+        if user_id not in self._sketches and not deltas["sketch_stale"]:
+            self._add_sketch(user_id, keyword_rows)
+        if self.cache.peek(user_id, "time_counts", _MISSING) is _MISSING:
+            counts = Counter(dict(time_rows))
+            counts.update(deltas["time_counts"])
+            counts.update(self._pending_times.get(user_id, {}))
+            self.cache.set(user_id, "time_counts", dict(counts))
+        if self.cache.peek(user_id, "patterns", _MISSING) is _MISSING:
+            patterns = Counter(dict(pattern_rows))
+            patterns.update(deltas["patterns"])
+            self.cache.set(user_id, "patterns", sorted(patterns.items(), key=lambda x: x[1], reverse=True)[:5])
+    
+    def _sketch(self, user_id):
+        sketch = self._sketches.get(user_id)
+        if sketch is not None:
+            self._sketches.move_to_end(user_id)
+            return sketch
         
-        # 获取现有兴趣
-        cursor.execute('SELECT interests FROM user_interests WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
+        # 没有预先读取（命令行工具等）时同步读取：
+        # 刚被换出的统计可能还在写队列里，先等它提交，否则会读到旧计数并在下次写入时覆盖
+        storage = self.storage.for_user(user_id)
+        storage.settle()
+        return self._add_sketch(user_id, storage.query(_KEYWORD_ROWS, (user_id,)))
+    
+    def _add_sketch(self, user_id, rows):
+        now = time.time()
+        sketch = SpaceSaving(KEYWORD_SKETCH_CAPACITY, half_life=KEYWORD_HALF_LIFE_DAYS * 86400, now=now)
+        for keyword, count, error, last_updated in rows:
+            sketch.load(keyword, count, error, age=self._age_seconds(last_updated), now=now)
         
-        if result:
-            interests = json.loads(result[0])
-        else:
-            interests = {
-                "topics": {},
-                "keywords": {},
-                "emotions": {}
-            }
-        
-        # 分析消息中的关键词和主题
-        keywords = self._extract_keywords(message)
-        for keyword in keywords:
-            interests["keywords"][keyword] = interests["keywords"].get(keyword, 0) + 1
-        
-        # 更新数据库
-        cursor.execute('''
-        INSERT OR REPLACE INTO user_interests (user_id, interests, last_updated)
-        VALUES (?, ?, ?)
-        ''', (user_id, json.dumps(interests), datetime.now()))
-        self.conn.commit()
+        self._sketches[user_id] = sketch
+        if len(self._sketches) > KEYWORD_SKETCH_USERS:
+            evicted_id, evicted = self._sketches.popitem(last=False)
+            if evicted_id in self._dirty_sketches:
+                self._dirty_sketches.discard(evicted_id)
+                self._submit_sketch_changes({evicted_id: evicted})
+                if evicted_id in self._loading:
+                    self._loading[evicted_id][1]["sketch_stale"] = True
+        return sketch
     
     def update_interaction_pattern(self, user_id, pattern_type):
         """更新用户互动模式"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
+        self.storage.for_user(user_id).execute('''
         INSERT INTO interaction_patterns (user_id, pattern_type, frequency, last_occurrence)
         VALUES (?, ?, 1, ?)
         ON CONFLICT(user_id, pattern_type) DO UPDATE SET
         frequency = frequency + 1,
         last_occurrence = ?
         ''', (user_id, pattern_type, datetime.now(), datetime.now()))
-        self.conn.commit()
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1]["patterns"][pattern_type] += 1
+        
+        # 写穿缓存中的前 5 个互动模式；新模式挤不进缓存的列表时让它失效
+        patterns = self.cache.peek(user_id, "patterns")
+        if patterns is None:
+            return
+        counts = dict(patterns)
+        if pattern_type in counts or len(counts) < 5:
+            counts[pattern_type] = counts.get(pattern_type, 0) + 1
+            self.cache.set(user_id, "patterns", sorted(counts.items(), key=lambda x: x[1], reverse=True))
+        else:
+            self.cache.invalidate(user_id, "patterns")
+    
+    def update_preferences(self, user_id, interaction_data):
+        """更新用户偏好（聊天时段计数，先在内存里累加）"""
+        time_period = self._get_time_period(datetime.now().hour)
+        self._pending_times[user_id][time_period] += 1
+        
+        counts = self.cache.peek(user_id, "time_counts")
+        if counts is not None:
+            if not counts.get(time_period):
+                # 这个时段第一次出现，个性化提示里的时段提示会变化
+                self.cache.invalidate(user_id, "prompt")
+            counts[time_period] = counts.get(time_period, 0) + 1
+        self._maybe_flush()
+    
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= LEARNER_FLUSH_SECONDS:
+            self.flush()
+    
+    def flush(self):
+        """把内存中累加的计数用 UPSERT 自增批量写入"""
+        self._last_flush = time.monotonic()
+        self._submit_sketch_changes({user_id: self._sketches[user_id] for user_id in self._dirty_sketches})
+        self._dirty_sketches = set()
+        
+        now = datetime.now()
+        time_rows = defaultdict(list)  # 分片 -> 行
+        for user_id, counts in self._pending_times.items():
+            loading = self._loading.get(user_id)
+            if loading is not None:
+                loading[1]["time_counts"].update(counts)
+            shard = self.storage.shard_index(user_id)
+            time_rows[shard].extend((user_id, period, n, now) for period, n in counts.items())
+        self._pending_times = defaultdict(Counter)
+        for shard, rows in time_rows.items():
+            self.storage.shard(shard).submit(lambda conn, rows=rows: self._write_time_counts(conn, rows))
+    
+    def _submit_sketch_changes(self, sketches):
+        """关键词统计只写变化的项（按当前时刻折算后的计数覆盖），并删除被挤出的项"""
+        now = datetime.now()
+        upserts = defaultdict(list)  # 分片 -> 行
+        deletes = defaultdict(list)
+        for user_id, sketch in sketches.items():
+            changed, removed = sketch.drain_changes()
+            shard = self.storage.shard_index(user_id)
+            upserts[shard].extend((user_id, keyword, count, error, now) for keyword, count, error in changed)
+            deletes[shard].extend((user_id, keyword) for keyword in removed)
+        for shard in set(upserts) | set(deletes):
+            self.storage.shard(shard).submit(
+                lambda conn, u=upserts[shard], d=deletes[shard]: self._write_keyword_counts(conn, u, d)
+            )
+    
+    def _write_keyword_counts(self, conn, upserts, deletes):
+        conn.executemany('DELETE FROM user_keyword_counts WHERE user_id = ? AND keyword = ?', deletes)
+        conn.executemany('''
+        INSERT INTO user_keyword_counts (user_id, keyword, count, error, last_updated)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, keyword) DO UPDATE SET
+        count = excluded.count,
+        error = excluded.error,
+        last_updated = excluded.last_updated
+        ''', upserts)
+    
+    def _write_time_counts(self, conn, time_rows):
+        conn.executemany('''
+        INSERT INTO user_time_counts (user_id, time_period, count, last_updated)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, time_period) DO UPDATE SET
+        count = count + excluded.count,
+        last_updated = excluded.last_updated
+        ''', time_rows)
+    
+    def get_top_keywords(self, user_id, k):
+        """最常出现的 k 个关键词 [(keyword, 次数)]，次数已按时间衰减折算"""
+        return [
+            (keyword, max(1, round(count)))
+            for keyword, count in self._sketch(user_id).top(k)
+        ]
+    
+    def get_time_counts(self, user_id):
+        return self.cache.get(user_id, "time_counts", lambda: self._load_time_counts(user_id))
+    
+    def _load_time_counts(self, user_id):
+        # 缓存以此为基础累加，先等排队中的写入提交，避免基数偏小（聊天流程里已由 preload 读好）
+        storage = self.storage.for_user(user_id)
+        storage.settle()
+        counts = Counter(dict(storage.query(_TIME_ROWS, (user_id,))))
+        counts.update(self._pending_times.get(user_id, {}))
+        return dict(counts)
+    
+    def get_patterns(self, user_id):
+        """最常见的 5 个互动模式 [(pattern_type, frequency)]"""
+        return self.cache.get(user_id, "patterns", lambda: self._load_patterns(user_id))
+    
+    def _load_patterns(self, user_id):
+        storage = self.storage.for_user(user_id)
+        storage.settle()
+        return storage.query(_PATTERN_ROWS, (user_id,))[:5]
     
     def get_user_profile(self, user_id):
         """获取用户画像"""
-        cursor = self.conn.cursor()
-        
-        # 获取兴趣
-        cursor.execute('SELECT interests FROM user_interests WHERE user_id = ?', (user_id,))
-        interests_result = cursor.fetchone()
-        interests = json.loads(interests_result[0]) if interests_result else {"topics": {}, "keywords": {}, "emotions": {}}
+        # 获取兴趣（只取最常出现的关键词）
+        interests = {
+            "topics": {},
+            "keywords": dict(self.get_top_keywords(user_id, PROFILE_TOP_KEYWORDS)),
+            "emotions": {}
+        }
         
         # 获取互动模式
-        cursor.execute('''
-        SELECT pattern_type, frequency 
-        FROM interaction_patterns 
-        WHERE user_id = ? 
-        ORDER BY frequency DESC 
-        LIMIT 5
-        ''', (user_id,))
-        patterns = cursor.fetchall()
+        patterns = self.get_patterns(user_id)
         
         # 获取偏好
-        cursor.execute('SELECT * FROM user_preferences_learned WHERE user_id = ?', (user_id,))
-        preferences = cursor.fetchone()
+        preferences = {"preferred_time": self.get_time_counts(user_id)}
         
         return {
             "interests": interests,
@@ -120,51 +396,68 @@ class PersonalityLearner:
         }
     
     def _extract_keywords(self, text):
-        """提取文本中的关键词"""
-        # 这里可以使用更复杂的NLP方法
-        # 现在简单实现，按空格分割
-        return text.split()
+        """提取文本中的关键词（词典分词后去掉停用词和单字）"""
+        return get_extractor().extract(text)
     
-    def update_preferences(self, user_id, interaction_data):
-        """更新用户偏好"""
-        cursor = self.conn.cursor()
-        
-        # 获取现有偏好
-        cursor.execute('SELECT * FROM user_preferences_learned WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            preferences = {
-                "preferred_topics": json.loads(result[1]),
-                "preferred_style": json.loads(result[2]),
-                "preferred_time": json.loads(result[3])
-            }
-        else:
-            preferences = {
-                "preferred_topics": {},
-                "preferred_style": {},
-                "preferred_time": {}
-            }
-        
-        # 更新偏好
-        current_hour = datetime.now().hour
-        time_period = self._get_time_period(current_hour)
+    def rebuild_interests(self, batch_size=5000, workers=1):
+        """用当前的关键词提取重新统计所有用户的兴趣（回填历史数据），返回处理的消息数"""
+        self.flush()
+        self.storage.flush()
+        self._sketches.clear()
+        self._dirty_sketches.clear()
         
-        preferences["preferred_time"][time_period] = preferences["preferred_time"].get(time_period, 0) + 1
-        
-        # 更新数据库
-        cursor.execute('''
-        INSERT OR REPLACE INTO user_preferences_learned 
-        (user_id, preferred_topics, preferred_style, preferred_time, last_updated)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            json.dumps(preferences["preferred_topics"]),
-            json.dumps(preferences["preferred_style"]),
-            json.dumps(preferences["preferred_time"]),
-            datetime.now()
-        ))
-        self.conn.commit()
+        extractor = get_extractor()
+        total = 0
+        # 逐个分片扫描
+        for storage in self.storage.all():
+            storage.run(lambda conn: conn.execute('DELETE FROM user_keyword_counts'))
+            # 先统计归档的旧消息，再统计 chat_history
+            batch = []
+            for row in self.archive.scan(storage, role="user"):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    total += self._count_keywords(batch, extractor, workers)
+                    batch = []
+            if batch:
+                total += self._count_keywords(batch, extractor, workers)
+            last_id = 0
+            while True:
+                rows = storage.query('''
+                SELECT id, user_id, message, timestamp FROM chat_history
+                WHERE role = 'user' AND id > ?
+                ORDER BY id
+                LIMIT ?
+                ''', (last_id, batch_size))
+                if not rows:
+                    break
+                total += self._count_keywords(rows, extractor, workers)
+                last_id = rows[-1][0]
+        self.storage.flush()
+        return total
+    
+    def _count_keywords(self, rows, extractor, workers):
+        """rows: [(id, user_id, message, timestamp)]，计入兴趣后写入，返回条数"""
+        keywords = extractor.extract_batch([row[2] or "" for row in rows], workers=workers)
+        now = time.time()
+        for (_, user_id, _, timestamp), words in zip(rows, keywords):
+            # 按消息原本的时间计入，时间衰减才准确
+            sent_at = now - self._age_seconds(timestamp)
+            sketch = self._sketch(user_id)
+            for keyword in words:
+                sketch.add(keyword, now=sent_at)
+            self._dirty_sketches.add(user_id)
+        self.flush()
+        return len(rows)
+    
+    def close(self):
+        """写入内存中剩余的计数"""
+        self.flush()
+    
+    def _age_seconds(self, timestamp):
+        try:
+            return max((datetime.now() - datetime.fromisoformat(timestamp)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return 0.0
     
     def _get_time_period(self, hour):
         """获取时间段"""
@@ -178,25 +471,35 @@ class PersonalityLearner:
             return "night"
     
     def get_personalized_prompt(self, user_id):
-        """获取个性化提示"""
-        profile = self.get_user_profile(user_id)
-        
+        """获取个性化提示（缓存渲染结果，兴趣或时段变化时重新生成）"""
+        time_period = self._get_time_period(datetime.now().hour)
+        cached = self.cache.get(user_id, "prompt", lambda: None)
+        if cached is not None and cached[0] == time_period:
+            return cached[1]
+        prompt = self._render_prompt(user_id, time_period)
+        self.cache.set(user_id, "prompt", (time_period, prompt))
+        return prompt
+    
+    def _render_prompt(self, user_id, time_period):
         # 构建个性化提示
         prompt_parts = []
         
         # 添加兴趣相关提示
-        if profile["interests"]["keywords"]:
-            top_keywords = sorted(
-                profile["interests"]["keywords"].items(),
-                key=lambda x: x[1],
-                reverse=True
-            )[:3]
+        top_keywords = self.get_top_keywords(user_id, 3)
+        if top_keywords:
             prompt_parts.append(f"主人对{', '.join(k[0] for k in top_keywords)}很感兴趣呢~")
         
         # 添加时间相关提示
-        current_hour = datetime.now().hour
-        time_period = self._get_time_period(current_hour)
-        if profile["preferences"] and time_period in profile["preferences"][2]:
+        if self.get_time_counts(user_id).get(time_period):
             prompt_parts.append(f"现在是{time_period}，主人通常这个时候都会来找我聊天呢~")
         
-        return " ".join(prompt_parts) 
\ No newline at end of file
+        return " ".join(prompt_parts) 
+
+if __name__ == "__main__":
+    # python personality_learner.py：换用新的关键词提取后，用聊天记录重建兴趣统计
+    from database import Database
+    Database()
+    learner = PersonalityLearner()
+    print(f"已重新统计 {learner.rebuild_interests(workers=4)} 条消息的关键词")
+    learner.close()
+    learner.storage.close()
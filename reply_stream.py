@@ -0,0 +1,81 @@
+# 流式回复：回复生成到一小段就先发出去，之后节流地编辑同一条消息补全内容
+# Telegram 对同一会话的编辑频率有限制，编辑间隔至少 STREAM_EDIT_INTERVAL 秒，
+# 被限流（RetryAfter）时按要求的时间推迟下一次发送或编辑；最终内容一定会发出去
+import asyncio
+import time
+
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from config import STREAM_EDIT_INTERVAL, STREAM_FIRST_CHARS
+from metrics import metrics
+
+MAX_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+
+def split_message(text, limit=MAX_LENGTH):
+    """按 Telegram 单条消息长度上限切分"""
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [text]
+
+
+class ReplyStream:
+    def __init__(self, message, interval=STREAM_EDIT_INTERVAL, first_chars=STREAM_FIRST_CHARS):
+        self.message = message  # 要回复的用户消息
+        self.interval = interval
+        self.first_chars = first_chars
+        self.sent = None  # 已发出的回复消息
+        self.shown = ""
+        self._next_edit = 0.0
+
+    async def update(self, text):
+        """回复又生成了一部分；没到编辑时间时直接跳过，只显示最新的内容"""
+        text = text[:MAX_LENGTH]
+        if self.sent is None:
+            if len(text) >= self.first_chars and time.monotonic() >= self._next_edit:
+                self.sent = await self._send(text, wait=False)
+                if self.sent is not None:
+                    self.shown = text
+                    self._next_edit = time.monotonic() + self.interval
+        elif text != self.shown and time.monotonic() >= self._next_edit:
+            await self._edit(text)
+
+    async def finish(self, text):
+        """发送最终内容，超出长度上限的部分另发新消息"""
+        chunks = split_message(text)
+        if self.sent is None:
+            for chunk in chunks:
+                await self._send(chunk)
+            return
+        while chunks[0] != self.shown:
+            await asyncio.sleep(max(self._next_edit - time.monotonic(), 0))
+            await self._edit(chunks[0])
+        for chunk in chunks[1:]:
+            await self._send(chunk)
+
+    async def _send(self, text, wait=True):
+        """发一条新消息；被限流时 wait 为真就等到允许后重发，否则放弃这次并推迟下一次，返回 None"""
+        while True:
+            try:
+                with metrics.stage("telegram_send"):
+                    return await self.message.reply_text(text)
+            except RetryAfter as e:
+                metrics.events.inc(event="telegram_retry_after")
+                if not wait:
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return None
+                await asyncio.sleep(e.retry_after)
+
+    async def _edit(self, text):
+        try:
+            with metrics.stage("telegram_edit"):
+                await self.sent.edit_text(text)
+        except RetryAfter as e:
+            metrics.events.inc(event="telegram_retry_after")
+            self._next_edit = time.monotonic() + e.retry_after
+            return
+        except BadRequest as e:
+            # 内容和上次相同时 Telegram 会报错，忽略即可
+            if "not modified" not in str(e):
+                raise
+        self.shown = text
+        self._next_edit = time.monotonic() + self.interval
@@ -0,0 +1,284 @@
+# RoBERTa 情感分析推理服务
+# 把并发聊天里的文本攒成一个批次（最多等几毫秒），一次前向推理后再把结果分发回各自的调用方。
+# worker=process 时推理放在独立进程里，分词和前向计算不占用机器人事件循环所在进程的 GIL
+# quantize=int8 时使用动态量化后的模型，首次转换后缓存到磁盘，并与 fp32 模型对比标签一致率
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (
+    SENTIMENT_MODEL, SENTIMENT_BATCH_SIZE, SENTIMENT_MAX_WAIT_MS, SENTIMENT_WORKER,
+    SENTIMENT_QUANTIZE, SENTIMENT_MIN_AGREEMENT, MODEL_CACHE_DIR
+)
+import upstream
+
+QUANTIZED_WEIGHTS = "quantized_state_dict.pt"
+AGREEMENT_REPORT = "agreement.json"
+
+# 量化模型的准确率检查样本
+SAMPLE_TEXTS = (
+    "今天天气真好，心情特别棒",
+    "这家店的菜太难吃了，再也不来了",
+    "晚安",
+    "在吗",
+    "好累啊，今天加班到十点",
+    "谢谢你一直陪着我",
+    "我好想你",
+    "服务态度很差，等了一个小时",
+    "考试终于通过了，太开心了",
+    "最近压力好大，睡不着",
+    "这部电影一般般吧",
+    "你怎么又不理我",
+    "周末一起去看海好不好",
+    "工作又被老板骂了",
+    "收到礼物了，好感动",
+    "一个人吃饭有点寂寞",
+    "明天要面试，好紧张",
+    "环境不错，价格也实惠",
+    "真是糟糕的一天",
+    "喜欢你喵~",
+)
+
+
+def _cache_dir(model, quantize):
+    return os.path.join(MODEL_CACHE_DIR, f"{model.replace('/', '__')}-{quantize}")
+
+
+def _quantize_dynamic(model):
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _build_quantized(model, cache_dir):
+    """把 fp32 模型动态量化为 int8，并把权重、配置和分词器缓存到 cache_dir"""
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer, pipeline
+
+    tokenizer = AutoTokenizer.from_pretrained(model)
+    fp32_model = AutoModelForSequenceClassification.from_pretrained(model).eval()
+    int8_model = _quantize_dynamic(fp32_model)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tokenizer.save_pretrained(cache_dir)
+    fp32_model.config.save_pretrained(cache_dir)
+    torch.save(int8_model.state_dict(), os.path.join(cache_dir, QUANTIZED_WEIGHTS))
+
+    fp32_pipeline = pipeline("sentiment-analysis", model=fp32_model, tokenizer=tokenizer)
+    int8_pipeline = pipeline("sentiment-analysis", model=int8_model, tokenizer=tokenizer)
+    return fp32_pipeline, int8_pipeline
+
+
+def _load_quantized(cache_dir):
+    """从缓存加载量化模型，不需要再下载或加载 fp32 权重"""
+    import torch
+    from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, pipeline
+
+    config = AutoConfig.from_pretrained(cache_dir)
+    int8_model = _quantize_dynamic(AutoModelForSequenceClassification.from_config(config))
+    int8_model.load_state_dict(torch.load(os.path.join(cache_dir, QUANTIZED_WEIGHTS)))
+    int8_model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+    return pipeline("sentiment-analysis", model=int8_model, tokenizer=tokenizer)
+
+
+def compare_labels(reference_pipeline, candidate_pipeline, texts=SAMPLE_TEXTS):
+    """对比两个模型在样本上的标签，返回一致率和不一致的样本"""
+    texts = list(texts)
+    reference = run_batch(reference_pipeline, texts)
+    candidate = run_batch(candidate_pipeline, texts)
+    mismatches = [
+        {"text": text, "reference": ref["label"], "candidate": cand["label"]}
+        for text, ref, cand in zip(texts, reference, candidate)
+        if ref["label"] != cand["label"]
+    ]
+    return {
+        "samples": len(texts),
+        "agreement": 1 - len(mismatches) / len(texts),
+        "mismatches": mismatches
+    }
+
+
+def _read_report(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, AGREEMENT_REPORT), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_report(cache_dir, report):
+    with open(os.path.join(cache_dir, AGREEMENT_REPORT), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def load_pipeline(model=SENTIMENT_MODEL, quantize=SENTIMENT_QUANTIZE):
+    from transformers import pipeline
+
+    if quantize == "none":
+        return pipeline("sentiment-analysis", model=model)
+    if quantize != "int8":
+        raise ValueError(f"不支持的量化方式：{quantize}")
+
+    cache_dir = _cache_dir(model, quantize)
+    if os.path.exists(os.path.join(cache_dir, QUANTIZED_WEIGHTS)):
+        report = _read_report(cache_dir)
+    else:
+        # 首次使用：转换、缓存，并和 fp32 对比一次
+        fp32_pipeline, int8_pipeline = _build_quantized(model, cache_dir)
+        report = compare_labels(fp32_pipeline, int8_pipeline)
+        _write_report(cache_dir, report)
+        print(f"int8 情感模型已缓存到 {cache_dir}，与 fp32 标签一致率 {report['agreement']:.1%}")
+        if report["agreement"] >= SENTIMENT_MIN_AGREEMENT:
+            return int8_pipeline
+        print(f"⚠️ 一致率低于 {SENTIMENT_MIN_AGREEMENT:.0%}，改用 fp32 模型")
+        return fp32_pipeline
+
+    if report is not None and report["agreement"] < SENTIMENT_MIN_AGREEMENT:
+        print(f"⚠️ int8 模型与 fp32 一致率 {report['agreement']:.1%}，低于 {SENTIMENT_MIN_AGREEMENT:.0%}，改用 fp32 模型")
+        return pipeline("sentiment-analysis", model=model)
+    return _load_quantized(cache_dir)
+
+
+def check_quantized(model=SENTIMENT_MODEL, quantize="int8"):
+    """重新对比缓存的量化模型和 fp32 模型，并更新报告"""
+    cache_dir = _cache_dir(model, quantize)
+    if not os.path.exists(os.path.join(cache_dir, QUANTIZED_WEIGHTS)):
+        load_pipeline(model, quantize)
+        return _read_report(cache_dir)
+    report = compare_labels(load_pipeline(model, "none"), _load_quantized(cache_dir))
+    _write_report(cache_dir, report)
+    return report
+
+
+def run_batch(sentiment_pipeline, texts):
+    """对一批文本做补齐后的批量推理"""
+    return sentiment_pipeline(texts, batch_size=len(texts), truncation=True)
+
+
+# 推理进程内的模型实例
+_worker_pipeline = None
+
+
+def _init_worker(model, quantize):
+    global _worker_pipeline
+    _worker_pipeline = load_pipeline(model, quantize)
+
+
+def _worker_run_batch(texts):
+    return run_batch(_worker_pipeline, texts)
+
+
+def _worker_ping():
+    return True
+
+
+class SentimentService:
+    def __init__(self, batch_size=SENTIMENT_BATCH_SIZE, max_wait_ms=SENTIMENT_MAX_WAIT_MS, worker=SENTIMENT_WORKER):
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.worker = worker
+        self._queue = None
+        self._task = None
+        self._pool = None
+        self._pipeline = None
+        # cold -> loading -> ready / failed
+        self.state = "cold"
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    async def warm_up(self):
+        """后台加载模型，加载完成前 ready 为 False，返回加载耗时（秒）"""
+        if self.state in ("loading", "ready"):
+            return 0.0
+        self.state = "loading"
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            if self.worker == "process":
+                # spawn 启动，避免 fork 带上父进程的线程和 torch 状态
+                self._pool = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(SENTIMENT_MODEL, SENTIMENT_QUANTIZE)
+                )
+                # 第一次提交任务才会启动进程并在其中加载模型
+                await loop.run_in_executor(self._pool, _worker_ping)
+            else:
+                self._pipeline = await upstream.run_blocking(load_pipeline)
+        except Exception as e:
+            print(f"情感模型加载失败：{e}")
+            self.state = "failed"
+            raise
+        self.state = "ready"
+        return loop.time() - start
+
+    async def classify(self, text):
+        """提交一条文本，等待所在批次推理完成后返回 {"label", "score"}
+
+        需要先 warm_up；调用方应在 ready 为 False 时走降级路径
+        """
+        if not self.ready:
+            raise RuntimeError(f"情感模型尚未就绪（{self.state}）")
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _infer(self, texts):
+        if self._pool is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, _worker_run_batch, texts)
+        return await upstream.run_blocking(run_batch, self._pipeline, texts)
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            texts = [text for text, _ in batch]
+            try:
+                results = await self._infer(texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+if __name__ == "__main__":
+    # python sentiment_service.py：检查 int8 模型与 fp32 模型的标签一致率
+    result = check_quantized()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
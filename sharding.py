@@ -0,0 +1,222 @@
+# 分片路由和迁移
+# 用户按 user_id 一致性哈希分到 DATABASE_SHARDS 个数据库分片（见 storage.ShardedStorage），
+# 分片再轮流分给 WORKER_COUNT 个工作进程（分片号 % 进程数）：每个分片只由一个进程读写，进程之间没有锁竞争。
+# webhook 模式下任何一个进程收到不属于自己的用户的更新时，转发给负责的进程处理。
+#
+# 修改分片数：停止所有进程，修改 DATABASE_SHARDS，然后运行
+#   python sharding.py            # 按 DATABASE_SHARDS 迁移
+#   python sharding.py --shards 8
+# 只有归属变化的用户会被搬走（一致性哈希下增加分片时约 1/N）；中途中断可以直接重新运行
+import argparse
+import sqlite3
+from collections import Counter
+
+import upstream
+from config import DATABASE_FILE, DATABASE_SHARDS, WORKER_COUNT, WORKER_INDEX, WORKER_URLS, WEBHOOK_SECRET
+from history_archive import decode_segment
+from storage import ShardedStorage, Storage, read_shard_count, shard_path, write_shard_count
+
+FORWARD_TIMEOUT = 5.0
+
+
+class WorkerRouter:
+    def __init__(self, storage, workers=WORKER_COUNT, index=WORKER_INDEX, urls=WORKER_URLS, secret=WEBHOOK_SECRET):
+        if not 0 <= index < workers:
+            raise ValueError(f"WORKER_INDEX={index} 超出范围（共 {workers} 个进程）")
+        if workers > 1 and len(urls) != workers:
+            raise ValueError(f"WORKER_URLS 需要列出全部 {workers} 个进程的地址")
+        # 分片比进程少时有的进程分不到分片，收到的更新全部转发出去，白白占着一个进程
+        if storage.count < workers:
+            raise ValueError(f"DATABASE_SHARDS={storage.count} 少于进程数 {workers}，有的进程分不到分片")
+        if storage.count % workers:
+            print(f"⚠️ DATABASE_SHARDS={storage.count} 不是进程数 {workers} 的整数倍，各进程负责的分片数不均")
+        self.storage = storage
+        self.workers = workers
+        self.index = index
+        self.urls = urls
+        self.secret = secret
+        self.forwarded = 0
+        self.forward_errors = 0
+
+    def worker_for_shard(self, shard):
+        # 分片数固定（改动需要停机迁移），不需要一致性哈希；取模能让各进程的分片数最多相差一个
+        return shard % self.workers
+
+    def worker_for(self, user_id):
+        return self.worker_for_shard(self.storage.shard_index(user_id))
+
+    def owns(self, user_id):
+        return self.worker_for(user_id) == self.index
+
+    def owned_shards(self):
+        return [shard for shard in range(self.storage.count) if self.worker_for_shard(shard) == self.index]
+
+    async def forward(self, update):
+        """把更新原样转发给负责该用户的进程"""
+        worker = self.worker_for(update.effective_user.id)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        try:
+            response = await upstream.get_http_client().post(
+                self.urls[worker], json=update.to_dict(), headers=headers, timeout=FORWARD_TIMEOUT
+            )
+            response.raise_for_status()
+            self.forwarded += 1
+        except Exception as e:
+            self.forward_errors += 1
+            print(f"⚠️ 转发更新给进程 {worker} 出错：{e}")
+
+    def stats(self):
+        return {
+            "owned_shards": len(self.owned_shards()),
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors
+        }
+
+
+# ---- 迁移 ----
+
+def _user_tables(conn):
+    """含 user_id 列的表 [(表名, 列名列表, 是否有自增 id)]"""
+    tables = []
+    for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall():
+        if name.startswith("sqlite_"):
+            continue
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")').fetchall()]
+        if "user_id" in columns:
+            tables.append((name, columns, "AUTOINCREMENT" in (sql or "").upper()))
+    # chat_history 先搬，其他表（chat_summaries.covered_until）要用到新旧 id 的对应关系
+    tables.sort(key=lambda t: t[0] != "chat_history")
+    return tables
+
+
+def _shard_users(storage, tables):
+    users = set()
+    for name, _, _ in tables:
+        users.update(row[0] for row in storage.query(f'SELECT DISTINCT user_id FROM "{name}"'))
+    users.discard(None)
+    return sorted(users)
+
+
+def _copy_user(conn, user_id, data):
+    """在目标分片上写入一个用户的全部数据（先删掉上次中断留下的部分）
+
+    自增 id 由目标分片重新分配（按原顺序插入，先后关系不变），并相应改写 chat_summaries.covered_until
+    """
+    dest_columns = {name: set(columns) for name, columns, _ in _user_tables(conn)}
+    id_map = {}
+    for (name, columns, autoincrement), rows in data:
+        if name not in dest_columns:
+            if rows:
+                print(f"  目标分片没有表 {name}，跳过用户 {user_id} 的 {len(rows)} 行")
+            continue
+        conn.execute(f'DELETE FROM "{name}" WHERE user_id = ?', (user_id,))
+        keep = [i for i, c in enumerate(columns)
+                if c in dest_columns[name] and not (autoincrement and c == "id")]
+        # 与目标分片里其他用户的唯一约束冲突（如 users.username 被别人用过）时不覆盖别人的数据
+        sql = (f'INSERT OR IGNORE INTO "{name}" ({", ".join(columns[i] for i in keep)}) '
+               f'VALUES ({", ".join("?" for _ in keep)})')
+        track = name == "chat_history" and autoincrement
+        for row in rows:
+            cursor = conn.execute(sql, [row[i] for i in keep])
+            if cursor.rowcount == 0:
+                print(f"  ⚠️ 用户 {user_id} 在表 {name} 的一行与目标分片已有数据冲突，未迁移：{row}")
+            elif track:
+                id_map[row[columns.index("id")]] = cursor.lastrowid
+        if name == "chat_summaries" and rows:
+            covered = rows[0][columns.index("covered_until")]
+            conn.execute(
+                'UPDATE chat_summaries SET covered_until = ? WHERE user_id = ?',
+                (max((new for old, new in id_map.items() if old <= covered), default=0), user_id)
+            )
+
+
+def _unarchived_history(source, user_id, columns):
+    """把用户的归档段解压成 chat_history 的行，按 id 从旧到新"""
+    rows = []
+    for (blob,) in source.query('SELECT data FROM chat_archive WHERE user_id = ? ORDER BY first_id', (user_id,)):
+        for row_id, message, role, timestamp in decode_segment(blob):
+            values = {"id": row_id, "user_id": user_id, "message": message, "role": role, "timestamp": timestamp}
+            rows.append(tuple(values.get(column) for column in columns))
+    return rows
+
+
+def _move_user(source, dest, user_id, tables):
+    data = [
+        (table, source.query(f'SELECT * FROM "{table[0]}" WHERE user_id = ? ORDER BY rowid', (user_id,)))
+        for table in tables
+    ]
+    names = [table[0] for table, _ in data]
+    if "chat_archive" in names and "chat_history" in names:
+        # 归档的消息解压回 chat_history 一起搬（id 会重新分配），到了新分片再由后台任务重新归档；
+        # chat_archive 本身不复制，只清掉目标分片上次中断留下的部分
+        archive = names.index("chat_archive")
+        history = names.index("chat_history")
+        table, rows = data[history]
+        data[history] = (table, _unarchived_history(source, user_id, table[1]) + rows)
+        data[archive] = (data[archive][0], [])
+    # 先在目标分片提交，再从原分片删除；中途中断时数据仍在原分片，重新运行会再搬一次
+    dest.run(lambda conn: _copy_user(conn, user_id, data))
+
+    def delete(conn):
+        for name, _, _ in tables:
+            conn.execute(f'DELETE FROM "{name}" WHERE user_id = ?', (user_id,))
+    source.run(delete)
+
+
+def rebalance(target, path=DATABASE_FILE):
+    """把数据从当前的分片布局迁移到 target 个分片，返回搬动的用户数（需停机执行）"""
+    from context_builder import ContextBuilder
+    from database import Database
+    from memory_index import MemoryIndex
+    from personality_learner import PersonalityLearner
+
+    current = read_shard_count(path) or 1
+    storage = ShardedStorage(target, path, check_layout=False)
+    # 在新布局的每个分片上建表
+    memory = MemoryIndex(storage=storage)
+    db = Database(storage=storage, memory=memory)
+    PersonalityLearner(storage=storage)
+    ContextBuilder(db, storage=storage)
+    storage.all()
+
+    moved = Counter()
+    retired = []
+    try:
+        for index in range(max(current, target)):
+            source = storage.shard(index) if index < target else Storage(shard_path(index, path))
+            try:
+                tables = source.run(_user_tables)
+                users = _shard_users(source, tables)
+                for user_id in users:
+                    dest = storage.shard_index(user_id)
+                    if dest == index:
+                        continue
+                    _move_user(source, storage.shard(dest), user_id, tables)
+                    # 消息的 id 变了，重建这个用户的长期记忆索引
+                    memory.rebuild_user(user_id)
+                    moved[(index, dest)] += 1
+            finally:
+                if index >= target:
+                    source.close()
+                    retired.append(shard_path(index, path))
+        write_shard_count(target, path)
+    finally:
+        storage.close()
+
+    for (source, dest), n in sorted(moved.items()):
+        print(f"  分片 {source} -> {dest}：{n} 个用户")
+    for retired_path in retired:
+        print(f"  {retired_path} 已不再使用，确认无误后可以删除")
+    print(f"分片数 {current} -> {target}，共搬动 {sum(moved.values())} 个用户")
+    return sum(moved.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按新的分片数迁移用户数据（需先停止所有进程）")
+    parser.add_argument("--shards", type=int, default=DATABASE_SHARDS, help="目标分片数，默认为 DATABASE_SHARDS")
+    args = parser.parse_args()
+    try:
+        rebalance(args.shards)
+    except sqlite3.Error as e:
+        print(f"❌ 迁移出错：{e}（修复后可以直接重新运行）")
+        raise SystemExit(1)
@@ -0,0 +1,126 @@
+# 语音合成：按句切分后并发合成，再按顺序拼接成一段 mp3
+# 短句（包括每条回复开头的固定情绪回应）按 声音+文本 的哈希缓存在磁盘上，重复的句子不再调用 ElevenLabs；
+# 启动后在后台把所有固定回应预先合成好（并发数单独限制，不和正在回复的语音抢名额）
+import asyncio
+import hashlib
+import os
+import re
+
+import upstream
+from config import (
+    AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_CHARS, TTS_CONCURRENCY, TTS_PREWARM_CONCURRENCY, TTS_MIN_SENTENCE_CHARS,
+    VOICE_MODEL
+)
+
+_sentences = re.compile(r"[^。！？!?~～…\n]+[。！？!?~～…]*")
+
+
+def split_sentences(text, min_chars=TTS_MIN_SENTENCE_CHARS):
+    """按句末标点切分，太短的句子并入下一句；不跨段落合并，固定回应总是单独成句"""
+    sentences = []
+    for paragraph in text.split("\n"):
+        pending = ""
+        for sentence in _sentences.findall(paragraph):
+            pending += sentence
+            if len(pending.strip()) >= min_chars:
+                sentences.append(pending.strip())
+                pending = ""
+        if pending.strip():
+            sentences.append(pending.strip())
+    return sentences
+
+
+class SpeechSynthesizer:
+    def __init__(self, cache_dir=AUDIO_CACHE_DIR, concurrency=TTS_CONCURRENCY, model=VOICE_MODEL,
+                 max_cached_chars=AUDIO_CACHE_MAX_CHARS, prewarm_concurrency=TTS_PREWARM_CONCURRENCY):
+        self.cache_dir = cache_dir
+        self.model = model
+        self.max_cached_chars = max_cached_chars
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._prewarm_semaphore = asyncio.Semaphore(prewarm_concurrency)
+        self._inflight = {}  # 同一句正在合成时，后来的请求等它的结果
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, text, voice_id):
+        key = hashlib.sha256(f"{self.model}\0{voice_id}\0{text}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, path, audio):
+        # 先写临时文件再改名，并发写入或中途退出都不会留下半个文件
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, path)
+
+    async def _sentence(self, text, voice_id, semaphore=None):
+        cacheable = len(text) <= self.max_cached_chars
+        path = self._path(text, voice_id)
+        if cacheable:
+            audio = self._read(path)
+            if audio:
+                self.hits += 1
+                return audio
+        self.misses += 1
+
+        inflight = self._inflight.get(path)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[path] = future
+        try:
+            async with semaphore or self._semaphore:
+                audio = await upstream.synthesize_speech(text, voice_id, self.model)
+            if cacheable:
+                self._write(path, audio)
+            future.set_result(audio)
+            return audio
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他请求在等时取走异常，避免“未获取的异常”警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[path]
+
+    async def synthesize(self, text, voice_id):
+        """合成整段文本，返回 mp3 字节（各句的 mp3 帧按顺序直接拼接）"""
+        sentences = split_sentences(text)
+        parts = await asyncio.gather(*(self._sentence(sentence, voice_id) for sentence in sentences))
+        return b"".join(parts)
+
+    async def prewarm(self, lines, voice_ids):
+        """预先合成并缓存固定的句子，返回新合成的句数；某个声音合成失败时跳过它剩下的句子"""
+        sentences = list(dict.fromkeys(
+            sentence for line in lines for sentence in split_sentences(line)
+            if len(sentence) <= self.max_cached_chars
+        ))
+        synthesized = 0
+        for voice_id in voice_ids:
+            missing = [s for s in sentences if not os.path.exists(self._path(s, voice_id))]
+            try:
+                await asyncio.gather(*(
+                    self._sentence(sentence, voice_id, self._prewarm_semaphore) for sentence in missing
+                ))
+            except Exception as e:
+                print(f"预先合成语音出错（声音 {voice_id}）：{e}")
+                continue
+            synthesized += len(missing)
+        return synthesized
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -0,0 +1,47 @@
+# 启动耗时统计
+# 记录导入和初始化各阶段的耗时，启动完成后打印报告，方便看清冷启动的时间花在哪里
+import time
+import unicodedata
+from contextlib import contextmanager
+
+_process_start = time.perf_counter()
+
+
+def _width(text):
+    """终端显示宽度（中文占两格）"""
+    return sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+
+
+def _pad(text, width):
+    return text + " " * (width - _width(text))
+
+
+class StartupTimer:
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    def elapsed(self):
+        """进程启动到现在的秒数"""
+        return time.perf_counter() - _process_start
+
+    def report(self, title="启动耗时"):
+        width = max((_width(name) for name, _ in self.stages), default=4)
+        lines = [f"⏱️ {title}："]
+        for name, seconds in self.stages:
+            lines.append(f"  {_pad(name, width)}  {seconds * 1000:8.1f} ms")
+        lines.append(f"  {_pad('总计', width)}  {self.elapsed() * 1000:8.1f} ms")
+        print("\n".join(lines))
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,330 @@
+# 共享的 SQLite 存储层
+# WAL 模式下读写互不阻塞：所有写操作排队交给唯一的写线程，每隔几毫秒合并成一个事务提交（组提交），
+# 读操作走各线程自己的只读连接，不等待排队中的写入。正常关闭时会把队列里的写入全部提交并做 checkpoint。
+# 数据按 user_id 一致性哈希分到多个数据库文件（ShardedStorage），每个分片有自己的写线程，互不争锁
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from config import DATABASE_FILE, DATABASE_SHARDS, STORAGE_FLUSH_MS, STORAGE_MAX_BATCH
+from hash_ring import HashRing
+from metrics import metrics
+
+_STOP = object()
+
+
+class _Maintenance:
+    """不能放在事务里执行的操作（如 incremental_vacuum）"""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, conn):
+        return self.fn(conn)
+
+
+class Storage:
+    def __init__(self, path=DATABASE_FILE, flush_ms=STORAGE_FLUSH_MS, max_batch=STORAGE_MAX_BATCH):
+        self.path = path
+        self.flush_interval = flush_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._closed = False
+        self._submitted = 0
+        self._completed = 0
+        self._submit_lock = threading.Lock()
+
+        self._write_conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # 只对新建的数据库生效；已有数据库需离线 VACUUM 一次才能转换（见 history_archive.py）
+        self._write_conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._write_conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 下 NORMAL 只在断电时可能丢最后几个事务，进程崩溃不会丢
+        self._write_conn.execute('PRAGMA synchronous=NORMAL')
+        self._write_conn.execute('PRAGMA busy_timeout=5000')
+
+        self._writer = threading.Thread(target=self._write_loop, name="storage-writer", daemon=True)
+        self._writer.start()
+
+    # ---- 写 ----
+
+    def submit(self, fn):
+        """把 fn(conn) 放进写队列，返回提交后完成的 Future
+
+        fn 在写线程里执行，读-改-写放在同一个 fn 里就不会和其他写入交错
+        """
+        if self._closed:
+            raise RuntimeError("存储已关闭")
+        future = Future()
+        # 事件循环和线程池里都会提交写入，计数要加锁
+        with self._submit_lock:
+            self._submitted += 1
+        self._queue.put((fn, future))
+        return future
+
+    def execute(self, sql, params=()):
+        """排队执行一条写语句，不等待提交"""
+        return self.submit(lambda conn: conn.execute(sql, params).rowcount)
+
+    def run(self, fn, timeout=None):
+        """排队执行并等待提交完成，返回 fn 的结果（建表等需要立即生效的操作）"""
+        return self.submit(fn).result(timeout)
+
+    def maintain(self, fn):
+        """在写线程里、事务之外执行 fn(conn)，返回完成后的 Future"""
+        return self.submit(_Maintenance(fn))
+
+    def flush(self, timeout=None):
+        """等待此前排队的写入全部提交"""
+        return self.run(lambda conn: None, timeout)
+
+    @property
+    def idle(self):
+        """没有排队或正在提交的写入"""
+        return self._completed >= self._submitted
+
+    def settle(self, timeout=None):
+        """有未提交的写入时等待其提交，用于缓存未命中时读到最新数据"""
+        if not self.idle:
+            self.flush(timeout)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch):
+        maintenance = [item for item in batch if isinstance(item[0], _Maintenance)]
+        if maintenance:
+            batch = [item for item in batch if not isinstance(item[0], _Maintenance)]
+            if batch:
+                self._commit_batch(batch)
+            for fn, future in maintenance:
+                self._run_maintenance(fn, future)
+            return
+        conn = self._write_conn
+        results = []
+        start = time.perf_counter()
+        ok = False
+        try:
+            conn.execute('BEGIN')
+            for fn, future in batch:
+                # 每个操作一个保存点，单个操作失败不影响同批的其他写入
+                conn.execute('SAVEPOINT op')
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute('RELEASE op')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO op')
+                    conn.execute('RELEASE op')
+                    print(f"❌ 写入数据库出错：{e}")
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+            ok = True
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"❌ 提交数据库事务出错：{e}")
+            results = [(future, None, e) for _, future in batch]
+        metrics.observe("db.write", time.perf_counter() - start, ok)
+        metrics.events.inc(len(batch), event="db_write_ops")
+
+        self._completed += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _run_maintenance(self, fn, future):
+        try:
+            result = fn(self._write_conn)
+        except Exception as e:
+            print(f"❌ 数据库维护出错：{e}")
+            self._completed += 1
+            future.set_exception(e)
+            return
+        self._completed += 1
+        future.set_result(result)
+
+    # ---- 读 ----
+
+    def _read_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+        return conn
+
+    def query(self, sql, params=()):
+        with metrics.stage("db.read"):
+            return self._read_conn().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with metrics.stage("db.read"):
+            return self._read_conn().execute(sql, params).fetchone()
+
+    # ---- 关闭 ----
+
+    def close(self):
+        """提交队列中的全部写入，checkpoint 后关闭连接"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._write_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._write_conn.close()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def shard_path(index, path=DATABASE_FILE):
+    """0 号分片沿用原来的文件，其余为 user_data.<n>.db"""
+    if index == 0:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.{index}{ext}"
+
+
+def read_shard_count(path=DATABASE_FILE):
+    """0 号分片里记录的分片数；数据库还不存在时为 None，分片之前的旧数据库视为 1"""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA busy_timeout=5000')
+        try:
+            row = conn.execute("SELECT value FROM storage_meta WHERE key = 'shard_count'").fetchone()
+        except sqlite3.OperationalError:
+            # 分片之前的数据库没有这张表，相当于 1 个分片
+            return 1
+    finally:
+        conn.close()
+    return int(row[0]) if row else 1
+
+
+def write_shard_count(count, path=DATABASE_FILE):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA busy_timeout=5000')
+        # 新数据库在建第一张表之前设好，之后再设需要 VACUUM
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute(
+            "INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('shard_count', ?)", (str(count),)
+        )
+    finally:
+        conn.close()
+
+
+class ShardedStorage:
+    """按 user_id 路由到分片的存储层
+
+    分片在第一次用到时才打开（多进程部署时每个进程只打开自己负责的分片），
+    ensure_schema 注册的建表函数会在每个分片上执行，包括之后才打开的分片
+    """
+
+    def __init__(self, shards=DATABASE_SHARDS, path=DATABASE_FILE, check_layout=True):
+        if shards < 1:
+            raise ValueError("分片数至少为 1")
+        self.count = shards
+        self.path = path
+        self.ring = HashRing(range(shards))
+        self._shards = {}
+        self._schemas = []
+        self._lock = threading.Lock()
+        self._closed = False
+        if check_layout:
+            self._check_layout()
+
+    def _check_layout(self):
+        recorded = read_shard_count(self.path)
+        if recorded is None:
+            write_shard_count(self.count, self.path)
+        elif recorded != self.count:
+            raise RuntimeError(
+                f"数据按 {recorded} 个分片存放，但 DATABASE_SHARDS={self.count}；"
+                f"请先停止所有进程，运行 python sharding.py 迁移"
+            )
+
+    def shard_index(self, user_id):
+        return self.ring.node_for(user_id)
+
+    def shard(self, index):
+        storage = self._shards.get(index)
+        if storage is not None:
+            return storage
+        with self._lock:
+            storage = self._shards.get(index)
+            if storage is None:
+                if self._closed:
+                    raise RuntimeError("存储已关闭")
+                storage = Storage(shard_path(index, self.path))
+                for fn in self._schemas:
+                    storage.run(fn)
+                self._shards[index] = storage
+        return storage
+
+    def for_user(self, user_id):
+        return self.shard(self.shard_index(user_id))
+
+    def all(self):
+        """全部分片（用于回填、重建等需要扫描所有用户的操作）"""
+        return [self.shard(index) for index in range(self.count)]
+
+    def opened(self):
+        return list(self._shards.values())
+
+    def ensure_schema(self, fn):
+        """在每个分片上执行建表函数 fn(conn)"""
+        with self._lock:
+            self._schemas.append(fn)
+            opened = list(self._shards.values())
+        for storage in opened:
+            storage.run(fn)
+
+    def flush(self, timeout=None):
+        for storage in self.opened():
+            storage.flush(timeout)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            shards, self._shards = list(self._shards.values()), {}
+        for storage in shards:
+            storage.close()
+
+
+_storage = None
+
+
+def get_storage():
+    """进程内共享的（分片）存储实例"""
+    global _storage
+    if _storage is None or _storage._closed:
+        _storage = ShardedStorage()
+    return _storage
@@ -0,0 +1,42 @@
+# 本地 token 计数
+# 优先使用 tiktoken 精确计数；tiktoken 不可用（未安装或离线拿不到编码表）时按字符粗略估算
+import re
+
+from config import GPT_MODEL
+
+# 每条消息除内容外的固定开销（角色、分隔符），参考 OpenAI 的计数说明
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMING = 3
+
+_cjk = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(GPT_MODEL)
+        except Exception as e:
+            print(f"tiktoken 不可用，改用估算的 token 数：{e}")
+    return _encoding
+
+
+def estimate_tokens(text):
+    """中文大约一字一个 token，其他字符大约四个一个 token"""
+    cjk = len(_cjk.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return estimate_tokens(text)
+
+
+def count_message_tokens(message):
+    return MESSAGE_OVERHEAD + count_tokens(message["content"])
@@ -0,0 +1,92 @@
+# 并发处理 Telegram 更新，同一会话内严格按顺序
+# 不同会话的更新并发处理，同时在处理的最多 CONCURRENT_UPDATES 个；同一会话的更新排队依次处理。
+# 等待中的更新超过 UPDATE_QUEUE_LIMIT（或同一会话超过 UPDATE_CHAT_QUEUE_LIMIT）时丢弃新到的更新，
+# 而不是无限堆积。
+# 多进程部署时（传入 router）不属于本进程的用户的更新转发给负责的进程处理；转发同样按会话排队，
+# 保证同一会话的更新按到达的顺序转发出去
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+from config import CONCURRENT_UPDATES, UPDATE_QUEUE_LIMIT, UPDATE_CHAT_QUEUE_LIMIT
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent=CONCURRENT_UPDATES, max_queued=UPDATE_QUEUE_LIMIT,
+                 max_queued_per_chat=UPDATE_CHAT_QUEUE_LIMIT, router=None):
+        # 基类的信号量只用来兜底，真正的并发上限在 do_process_update 里按会话排队之后再限制，
+        # 否则同一会话排队等待的更新会占着并发名额
+        super().__init__(max_concurrent + max_queued + 1)
+        self.max_queued = max_queued
+        self.max_queued_per_chat = max_queued_per_chat
+        self.router = router
+        self._limit = asyncio.Semaphore(max_concurrent)
+        self._chats = {}  # 会话 -> [锁, 排队和处理中的更新数]
+        self.waiting = 0
+        self.running = 0
+        self.shed = 0
+
+    def _chat_key(self, update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        return user.id if user is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        forward = self.router is not None and user is not None and not self.router.owns(user.id)
+        if forward:
+            coroutine.close()
+
+        key = self._chat_key(update)
+        chat = self._chats.get(key)
+        if self.waiting >= self.max_queued or (chat is not None and chat[1] >= self.max_queued_per_chat):
+            self.shed += 1
+            if not forward:
+                coroutine.close()
+            print(f"⚠️ 待处理的更新过多，丢弃会话 {key} 的一条更新")
+            return
+
+        if chat is None:
+            chat = self._chats[key] = [asyncio.Lock(), 0]
+        chat[1] += 1
+        self.waiting += 1
+        waiting = True
+        try:
+            # asyncio.Lock 按到达顺序唤醒，同一会话的更新保持原来的顺序
+            async with chat[0]:
+                if forward:
+                    # 转发只是一次 HTTP 请求，不占处理更新的并发名额
+                    self.waiting -= 1
+                    waiting = False
+                    await self.router.forward(update)
+                    return
+                async with self._limit:
+                    self.waiting -= 1
+                    waiting = False
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+        finally:
+            if waiting:
+                self.waiting -= 1
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "chats": len(self._chats),
+            "shed": self.shed
+        }
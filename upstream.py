@@ -0,0 +1,235 @@
+# 上游服务客户端
+# OpenAI 和 ElevenLabs 走同一个带连接池的异步 HTTP 客户端，
+# Stability 只有同步的 gRPC 客户端，放到有上限的线程池里执行，避免卡住事件循环；
+# 生图和后台维护（归档压缩）各用自己的线程池，卡住的生图请求不会占满召回、情感分析等共用的线程池
+# openai 和 stability_sdk 导入较慢，首次使用时才导入
+# 每次调用都经过对应服务的熔断器，超时取服务自己的超时和本条消息剩余时间中较小的一个（见 deadlines.py）
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from config import (
+    OPENAI_API_KEY, ELEVENLABS_API_KEY, STABILITY_API_KEY, ELEVENLABS_API_URL,
+    GPT_MODEL, VOICE_MODEL, UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_KEEPALIVE_EXPIRY, BLOCKING_WORKERS, IMAGE_WORKERS, OPENAI_TIMEOUT, ELEVENLABS_TIMEOUT, STABILITY_TIMEOUT
+)
+from deadlines import CircuitBreaker
+from metrics import metrics
+from token_counter import REPLY_PRIMING, count_message_tokens, count_tokens
+
+_http_client = None
+_openai_client = None
+_stability_api = None
+_executors = {}
+
+breakers = {name: CircuitBreaker(name) for name in ("openai", "elevenlabs", "stability")}
+
+
+def available(service):
+    """服务没有熔断，可以调用"""
+    return breakers[service].available
+
+
+def breaker_stats():
+    return {"service": {name: breaker.stats() for name, breaker in breakers.items()}}
+
+
+def get_http_client():
+    """共享的异步 HTTP 客户端（长连接复用）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
+    return _http_client
+
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=get_http_client(), timeout=OPENAI_TIMEOUT)
+    return _openai_client
+
+
+def get_stability_api():
+    global _stability_api
+    if _stability_api is None:
+        from stability_sdk import client
+        _stability_api = client.StabilityInference(key=STABILITY_API_KEY, verbose=True)
+        # gRPC 调用本身也带超时：熔断器超时后不再等待，但线程要等请求结束才能释放
+        _stability_api.grpc_args["timeout"] = STABILITY_TIMEOUT
+    return _stability_api
+
+
+# 线程池名 -> 线程数
+_POOLS = {"upstream": BLOCKING_WORKERS, "stability": IMAGE_WORKERS, "background": 1}
+
+
+def get_executor(name="upstream"):
+    executor = _executors.get(name)
+    if executor is None:
+        executor = _executors[name] = ThreadPoolExecutor(max_workers=_POOLS[name], thread_name_prefix=name)
+    return executor
+
+
+async def _run_in(name, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(name), functools.partial(func, *args, **kwargs))
+
+
+async def run_blocking(func, *args, **kwargs):
+    """在有上限的线程池里执行同步调用"""
+    return await _run_in("upstream", func, *args, **kwargs)
+
+
+async def run_background(func, *args, **kwargs):
+    """在单独的线程池里执行耗时较长的后台维护（不占用处理消息用的线程池）"""
+    return await _run_in("background", func, *args, **kwargs)
+
+
+async def chat_completion(messages, model=GPT_MODEL, timeout=OPENAI_TIMEOUT, stage=None, **kwargs):
+    """调用 OpenAI 对话补全，返回回复文本；给出 stage 时把这次调用的耗时记为该阶段"""
+    return await _timed(stage, breakers["openai"].call(_chat_completion, messages, model, timeout=timeout, **kwargs))
+
+
+async def _timed(stage, coro):
+    if stage is None:
+        return await coro
+    with metrics.stage(stage):
+        return await coro
+
+
+async def _chat_completion(messages, model, **kwargs):
+    response = await get_openai_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        **kwargs
+    )
+    if response.usage is not None:
+        metrics.count_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+    return response.choices[0].message.content
+
+
+async def stream_chat_completion(messages, on_partial, model=GPT_MODEL, timeout=OPENAI_TIMEOUT, stage=None,
+                                 **kwargs):
+    """流式调用对话补全，每收到一段就用目前为止的全文调用 on_partial，返回完整文本
+
+    超时从发出请求算到输出完毕。on_partial（发送、编辑 Telegram 消息）在调用方这边执行，
+    它的耗时和出错不计入 OpenAI 的超时、熔断和 stage 阶段的耗时；它还没执行完时收到的几段只保留最新的全文
+    """
+    latest = None
+    received = asyncio.Event()
+
+    async def receive(content):
+        nonlocal latest
+        latest = content
+        received.set()
+
+    completion = asyncio.create_task(_timed(
+        stage, breakers["openai"].call(_stream_chat_completion, messages, receive, model, timeout=timeout, **kwargs)
+    ))
+    try:
+        while True:
+            waiter = asyncio.create_task(received.wait())
+            await asyncio.wait({completion, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if received.is_set():
+                received.clear()
+                await on_partial(latest)
+            elif completion.done():
+                return completion.result()
+    finally:
+        if not completion.done():
+            completion.cancel()
+            await asyncio.gather(completion, return_exceptions=True)
+
+
+async def _stream_chat_completion(messages, on_partial, model, **kwargs):
+    stream = await get_openai_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **kwargs
+    )
+    content = ""
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            content += delta
+            await on_partial(content)
+    # 流式响应不带用量，按本地计数记录
+    metrics.count_tokens(REPLY_PRIMING + sum(count_message_tokens(m) for m in messages), count_tokens(content))
+    return content
+
+
+async def synthesize_speech(text, voice_id, model=VOICE_MODEL, timeout=ELEVENLABS_TIMEOUT):
+    """调用 ElevenLabs 语音合成，返回 mp3 字节"""
+    return await breakers["elevenlabs"].call(_synthesize_speech, text, voice_id, model, timeout=timeout)
+
+
+async def _synthesize_speech(text, voice_id, model):
+    response = await get_http_client().post(
+        f"{ELEVENLABS_API_URL}/text-to-speech/{voice_id}",
+        headers={"xi-api-key": ELEVENLABS_API_KEY, "accept": "audio/mpeg"},
+        json={"text": text, "model_id": model}
+    )
+    response.raise_for_status()
+    return response.content
+
+
+def _stability_generate(prompt, seed, steps, cfg_scale, width, height, samples):
+    import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
+    answers = get_stability_api().generate(
+        prompt=prompt,
+        seed=seed,
+        steps=steps,
+        cfg_scale=cfg_scale,
+        width=width,
+        height=height,
+        samples=samples,
+        sampler=generation.SAMPLER_K_DPMPP_2M
+    )
+    images = []
+    for resp in answers:
+        for artifact in resp.artifacts:
+            if artifact.type == generation.ARTIFACT_IMAGE:
+                images.append(artifact.binary)
+    return images
+
+
+async def generate_image(prompt, seed=42, steps=30, cfg_scale=7.0, width=512, height=512, samples=1,
+                         timeout=STABILITY_TIMEOUT):
+    """调用 Stability 生成图片，返回图片字节列表
+
+    gRPC 客户端是同步的，超时后不再等待结果，线程里的请求最多执行到 gRPC 自己的超时（STABILITY_TIMEOUT）
+    """
+    return await breakers["stability"].call(
+        _generate_image, prompt, timeout=timeout,
+        seed=seed, steps=steps, cfg_scale=cfg_scale, width=width, height=height, samples=samples
+    )
+
+
+async def _generate_image(prompt, **params):
+    return await _run_in("stability", _stability_generate, prompt, **params)
+
+
+async def close():
+    """关闭连接池和线程池"""
+    global _http_client, _openai_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        _openai_client = None
+    for executor in _executors.values():
+        executor.shutdown(wait=False)
+    _executors.clear()
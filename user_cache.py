@@ -0,0 +1,84 @@
+# 按用户的状态缓存
+# 缓存偏好设置、画像数据和渲染好的个性化提示，写入时同步更新或失效（write-through），
+# 按用户 LRU 淘汰，并按字段统计命中率。稳定状态下聊天流程几乎不需要读数据库
+from collections import Counter, OrderedDict
+
+from config import USER_CACHE_SIZE
+
+
+class UserStateCache:
+    def __init__(self, max_users=USER_CACHE_SIZE):
+        self.max_users = max_users
+        self._entries = OrderedDict()  # user_id -> {字段: 值}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = {}
+            self._entries[user_id] = entry
+            if len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def get(self, user_id, field, loader):
+        """取缓存的字段，未命中时调用 loader() 加载并缓存（None 也会被缓存）"""
+        entry = self._entry(user_id)
+        if field in entry:
+            self.hits[field] += 1
+            return entry[field]
+        self.misses[field] += 1
+        value = loader()
+        entry[field] = value
+        return value
+
+    def peek(self, user_id, field, default=None):
+        """只看缓存，不加载、不计入命中率"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return default
+        return entry.get(field, default)
+
+    def set(self, user_id, field, value):
+        self._entry(user_id)[field] = value
+
+    def invalidate(self, user_id, *fields):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        if not fields:
+            del self._entries[user_id]
+            return
+        for field in fields:
+            entry.pop(field, None)
+
+    def stats(self):
+        fields = set(self.hits) | set(self.misses)
+        total_hits = sum(self.hits.values())
+        total = total_hits + sum(self.misses.values())
+        return {
+            "users": len(self._entries),
+            "hit_rate": total_hits / total if total else 0.0,
+            "fields": {
+                field: {
+                    "hits": self.hits[field],
+                    "misses": self.misses[field],
+                    "hit_rate": self.hits[field] / (self.hits[field] + self.misses[field])
+                }
+                for field in sorted(fields)
+            }
+        }
+
+
+_cache = None
+
+
+def get_user_cache():
+    """进程内共享的用户状态缓存"""
+    global _cache
+    if _cache is None:
+        _cache = UserStateCache()
+    return _cache